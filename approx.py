@@ -0,0 +1,101 @@
+# APPROXIMATE FITS OF THE NATIONAL MODEL
+#
+# For quick updates, the posterior of `house.stan` can be approximated either
+# with Stan's variational inference (ADVI) or with a normal approximation at
+# the posterior mode (Laplace). Both return draws of `mu` and `alpha_n` shaped
+# like those from full sampling. Summaries of the last full NUTS run are kept
+# so the approximation can be compared against it.
+
+import os
+import pickle
+
+import numpy as np
+
+import cache
+
+METHODS = ["meanfield", "fullrank", "laplace"]
+
+
+def draw(model, mcmc_data, method, n):
+    if method == "laplace":
+        return laplace_draws(model, mcmc_data, n)
+    return advi_draws(model, mcmc_data, n, algorithm=method)
+
+def advi_draws(model, mcmc_data, n, algorithm="meanfield"):
+    fit = model.vb(data=mcmc_data, algorithm=algorithm, output_samples=n)
+    names = fit["sampler_param_names"]
+    params = np.asarray(fit["sampler_params"])
+
+    def extract(par, size):
+        rows = [names.index(f"{par}[{i}]") for i in range(1, size + 1)]
+        return params[rows].T
+
+    return {"mu": extract("mu", mcmc_data["W"]), "alpha_n": extract("alpha_n", mcmc_data["M"])}
+
+# Normal approximation on the unconstrained scale around the posterior mode,
+# using the Hessian Stan computes there. Unconstrained parameters are laid out
+# in declaration order: alpha_n_r, alpha_p_r, delta_mu, u, sigma_p, sigma_e,
+# sigma_walk.
+def laplace_draws(model, mcmc_data, n):
+    W, M, P, N = (mcmc_data[k] for k in ["W", "M", "P", "N"])
+    opt = model.optimizing(data=mcmc_data, hessian=True, as_vector=False)
+    par = opt["par"]
+
+    mode = np.concatenate([par["alpha_n_r"], par["alpha_p_r"], par["delta_mu"], par["u"],
+                           [logit(par["sigma_p"] / 0.15), logit(par["sigma_e"] / 0.15),
+                            np.log(par["sigma_walk"])]])
+    cov = np.linalg.inv(-np.asarray(opt["hessian"]))
+    z = np.random.multivariate_normal(mode, (cov + cov.T) / 2, n)
+
+    alpha_n_r = z[:, :M]
+    delta_mu = z[:, M + P:M + P + W]
+    sigma_walk = np.exp(z[:, -1])
+
+    return {
+        "mu": random_walk(delta_mu, sigma_walk, mcmc_data["mu_prior"], mcmc_data["mu_mse"]),
+        "alpha_n": mcmc_data["alpha_n_prior"]
+            + alpha_n_r @ np.linalg.cholesky(mcmc_data["sigma_n_prior"]).T,
+    }
+
+# `mu` as defined in house.stan, one row per draw.
+def random_walk(delta_mu, sigma_walk, mu_prior, mu_mse):
+    steps = delta_mu[:, 1:]
+    tail = steps.sum(axis=1, keepdims=True) - np.cumsum(steps, axis=1)
+    tail = np.hstack([steps.sum(axis=1, keepdims=True), tail])
+    return mu_prior + mu_mse * delta_mu[:, -1:] + sigma_walk[:, None] * tail
+
+def logit(p):
+    return np.log(p / (1 - p))
+
+
+#################################
+# Comparison with full NUTS     #
+#################################
+
+# `summary` is as from `posterior.summarize`.
+def save_reference(path, summary):
+    summary = {k: {"mean": v["mean"], "std": v["std"]} for k, v in summary.items()}
+    cache.write(path, pickle.dumps(summary))
+
+# Differences between the approximate draws and the last full NUTS run, in
+# percentage points, aligned at election day. `kl` is the mean KL divergence
+# of the approximate marginals from the NUTS ones, both taken as normal.
+def compare(path, samples):
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        reference = pickle.load(f)
+
+    comparison = {}
+    for k, v in samples.items():
+        n = min(v.shape[1], len(reference[k]["mean"]))
+        mean, std = v.mean(axis=0)[-n:], v.std(axis=0)[-n:]
+        ref_mean, ref_std = reference[k]["mean"][-n:], reference[k]["std"][-n:]
+        kl = (np.log(ref_std / std) + (std**2 + (mean - ref_mean)**2) / (2 * ref_std**2) - 0.5)
+        comparison[k] = {
+            "max_mean_diff": float(100 * np.max(np.abs(mean - ref_mean))),
+            "final_mean_diff": float(100 * (mean[-1] - ref_mean[-1])),
+            "std_ratio": float(np.mean(std / ref_std)),
+            "kl": float(np.mean(kl)),
+        }
+    return comparison
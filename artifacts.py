@@ -0,0 +1,61 @@
+# DEPENDENCY TRACKING FOR STORED MODELS
+#
+# Each stored model is recorded in a manifest next to it, together with a hash
+# of everything that went into it: data files, the source of the functions
+# that build it, and the versions of the libraries involved. A stored model is
+# only reused if that hash is unchanged.
+
+import os
+import json
+import hashlib
+import inspect
+from importlib import metadata
+
+import cache
+
+
+def artifact_key(files=(), code=(), libraries=()):
+    h = hashlib.sha256()
+    for filename in files:
+        h.update(filename.encode("utf-8"))
+        with open(filename, "rb") as f:
+            h.update(f.read())
+    for func in code:
+        h.update(inspect.getsource(func).encode("utf-8"))
+    for library in libraries:
+        try:
+            version = metadata.version(library)
+        except metadata.PackageNotFoundError:
+            version = "unknown"
+        h.update(f"{library}=={version}".encode("utf-8"))
+
+    return h.hexdigest()
+
+# Models stored before they were tracked (such as those committed to the repo)
+# have no manifest entry; they are taken to be current, and their key recorded.
+def is_current(path, key):
+    if not os.path.isfile(path):
+        return False
+    recorded = read_manifest(path).get(os.path.basename(path))
+    if recorded is None:
+        record(path, key)
+        return True
+    return recorded == key
+
+def record(path, key):
+    manifest = read_manifest(path)
+    manifest[os.path.basename(path)] = key
+
+    cache.write(get_manifest_path(path),
+                json.dumps(manifest, indent=4, sort_keys=True).encode("utf-8"))
+
+
+def get_manifest_path(path):
+    return os.path.join(os.path.dirname(path), "artifacts.json")
+
+def read_manifest(path):
+    manifest_path = get_manifest_path(path)
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
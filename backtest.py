@@ -0,0 +1,213 @@
+# BACKTESTS ON PAST CYCLES
+#
+# Replays past cycles as of chosen days before each election: priors are refit
+# without the cycle being tested, the national model is fit to that cycle's
+# generic ballot polls (from data/raw-polls.csv, which only has polls from the
+# last three weeks of each campaign), and races are simulated as in a forecast,
+# one process per cycle and date. Forecasts are scored against the results:
+# Brier scores and calibration of district probabilities, the error in the
+# national margin and the seat count, and the Brier score of the majority
+# probability. The runtime of each cycle is reported alongside, so accuracy and
+# speed can be judged together.
+#
+#   ./house.py backtest --cycles 2006 2010 --days_before 7 14
+#
+# The districts simulated are those in data/cd_president.tsv with a lean and a
+# presidential margin for the cycle (so the lines drawn for it), with
+# incumbents from the cycle's results; districts missing from the results or
+# uncontested are not scored. The data has no 2008 vote for 12 districts drawn
+# in 2012, so 2014 is simulated without them, and its seat counts and majority
+# probability are understated. The results only go back to 2000 and stop at
+# 2014, so 2016 can't be replayed. Dates before a cycle's first poll are
+# skipped.
+
+import json
+import time
+import argparse
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import house
+import pollstore
+import timing
+
+CYCLES = [2002, 2004, 2006, 2008, 2010, 2012, 2014]
+
+# seats Democrats won in each cycle
+DEM_SEATS = {2000: 212, 2002: 205, 2004: 202, 2006: 233, 2008: 257, 2010: 193, 2012: 201, 2014: 188}
+
+BINS = np.linspace(0, 1, 11)
+
+
+def run(args):
+    import priors
+
+    args = argparse.Namespace(**{**vars(args), "dry": True, "warm_start": False,
+                                 "save_draws": False, "save_scenarios": False})
+
+    timing.start("load data")
+    model = house.load_model(args.model_dir, args.recompile)
+    nat_data = priors.national_prior_data()
+    race_data = priors.prepare_race_data()
+    generic = priors.get_generic_polling()
+    polls = get_polls()
+    shared = {
+        "model": model,
+        "approvals": priors.get_approvals_data(),
+        "cd_vote": priors.get_pvi_data(),
+    }
+
+    timing.start("fit priors")
+    cycles = {}
+    outcomes = {}
+    for year in args.cycles:
+        info = cycle_info(year, nat_data)
+        results = priors.summarize_races(priors.get_results(year))
+        districts = shared["cd_vote"].dropna(subset=[info["pvi"], info["adj"]]).index
+        if len(districts) < 435:
+            print(f"{year}: only {len(districts)} districts have a lean and presidential margin.")
+        incumbent = results.incumbent.reindex(districts, fill_value=0)
+        cycles[year] = {
+            **shared,
+            "nat_prior": priors.fit_national_prior(nat_data.drop(year, errors="ignore")),
+            "race_prior": priors.fit_race_prior(race_data[race_data.index != year]),
+            "bias_prior": priors.fit_bias_prior(generic[generic.year != year]),
+            "polls": cycle_polls(polls, year),
+            "incumbents": pd.DataFrame({"district": districts, "incumbent": incumbent.values},
+                                       index=districts),
+            "not_running": [],
+            "cycle": info,
+        }
+        outcomes[year] = {
+            "margins": results.margin,
+            "nat_margin": float(polls[polls.year == year].margin_actual.iloc[0]),
+            "seats": DEM_SEATS[year],
+        }
+
+    timing.start("run cycles")
+    jobs = [(year, datetime.combine(house.election_day(year) - timedelta(days=days),
+                                    datetime.min.time()))
+            for year in args.cycles for days in args.days_before]
+    for year, max_date in list(jobs):
+        if cycles[year]["polls"].polls.end_date.min() > max_date:
+            print(f"{year}: skipping {max_date:%Y-%m-%d}, before the first poll "
+                  f"({cycles[year]['polls'].polls.end_date.min():%Y-%m-%d}).")
+            jobs.remove((year, max_date))
+    if not jobs:
+        raise ValueError("No polls before any of the backtest dates.")
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=house.init_worker,
+                             initargs=(cycles, args)) as pool:
+        runs = list(pool.map(backtest_worker, *zip(*jobs)))
+
+    timing.start("score")
+    rows = []
+    scored = []
+    for (year, max_date), (output_data, seconds) in zip(jobs, runs):
+        row, districts = score(output_data, outcomes[year])
+        rows.append({"cycle": year, "as_of": f"{max_date:%Y-%m-%d}", "seconds": seconds, **row})
+        scored.append(districts)
+
+    report = {"cycles": rows, "calibration": calibration(pd.concat(scored)),
+              "brier": float(pd.concat(scored).eval("(prob - won)**2").mean()),
+              "seconds": sum(r["seconds"] for r in rows)}
+    with open(args.backtest_file, "w") as f:
+        json.dump(report, f, indent=4)
+
+    print_report(report)
+    print(f"Backtest written to {args.backtest_file}.")
+
+def backtest_worker(year, max_date):
+    inputs = house._worker_state["inputs"][year]
+    start = time.perf_counter()
+    output_data = house.forecast(max_date, inputs, house._worker_state["args"])
+    return output_data, time.perf_counter() - start
+
+
+# Generic ballot polls of past cycles, in the form `house.fetch_polls` returns.
+def get_polls():
+    raw = pd.read_csv("data/raw-polls.csv", lineterminator="\r")
+    raw = raw[(raw.type_simple == "House-G") & (raw.location == "US")]
+    poll_date = pd.to_datetime(raw.polldate, format="%m/%d/%y")
+
+    return pd.DataFrame({
+        "year": raw.year.values,
+        "poll_slug": raw.pollno.astype(str).values,
+        "sample_subpopulation": "Likely Voters",
+        "survey_house": raw.pollster.values,
+        "start_date": poll_date.values,
+        "end_date": poll_date.values,
+        "Democrat": raw.cand1_pct.values,
+        "Republican": raw.cand2_pct.values,
+        "n_resp": raw.samplesize.values,
+        "margin_actual": raw.margin_actual.values,
+    })
+
+def cycle_polls(polls, year):
+    store = pollstore.PollStore(house.election_day(year))
+    store.update(polls[polls.year == year].dropna(subset=["n_resp"]))
+    return store
+
+# Like `house.CYCLE`, for a past year. District lean and presidential margin
+# are chosen as in `priors.prepare_race_data`.
+def cycle_info(year, nat_data):
+    if year % 4 == 0: # presidential election year
+        pvi, adj = f"pvi_{year - 2}", f"pres_margin_{str(year - 4)[-2:]}"
+    else:
+        pvi, adj = f"pvi_{year}", f"pres_margin_{str(year - 2)[-2:]}"
+
+    return {
+        "year": year,
+        "INC": int(nat_data.loc[year, "INC"]),
+        "PRES": int(nat_data.loc[year, "PRES"]),
+        "MID": int(nat_data.loc[year, "MID"]),
+        "pvi": pvi,
+        "adj": adj,
+        "seats": DEM_SEATS[year - 2],
+        "majority": house.CYCLE["majority"],
+    }
+
+
+def score(output_data, outcome):
+    districts = output_data["districts"].set_index("district")
+    districts = districts.assign(margin=outcome["margins"].reindex(districts.index))
+    districts = districts.dropna(subset=["margin"])
+    districts["won"] = (districts.margin > 0).astype(float)
+
+    won_majority = float(outcome["seats"] >= house.CYCLE["majority"])
+    return {
+        "prob": float(output_data["prob"]),
+        "seats": int(output_data["seats"]),
+        "seats_actual": outcome["seats"],
+        "seats_error": int(output_data["seats"] - outcome["seats"]),
+        "seats_covered": bool(output_data["seats_min"] <= outcome["seats"] <= output_data["seats_max"]),
+        "majority_brier": float((output_data["prob"] - won_majority)**2),
+        "nat_margin": float(output_data["generic"].margin.iloc[-1]),
+        "nat_error": float(output_data["generic"].margin.iloc[-1] - outcome["nat_margin"]),
+        "brier": float(((districts.prob - districts.won)**2).mean()),
+        "districts": len(districts),
+    }, districts[["prob", "won"]]
+
+# Observed share of districts won by Democrats, by predicted probability.
+def calibration(districts):
+    bins = pd.cut(districts.prob, BINS, include_lowest=True)
+    table = districts.groupby(bins, observed=True).agg(
+            predicted=("prob", "mean"), observed=("won", "mean"), n=("won", "size"))
+    return [{"bin": str(b), **{k: float(v) for k, v in row.items()}}
+            for b, row in table.iterrows()]
+
+
+def print_report(report):
+    print("Cycle  As of       Brier  Maj. Brier  Nat. err  Seats (actual)  Time")
+    for r in report["cycles"]:
+        print(f"{r['cycle']}   {r['as_of']}  {r['brier']:.4f}  {r['majority_brier']:10.4f}  "
+              f"{r['nat_error']:+8.1f}  {r['seats']:5d} ({r['seats_actual']})   "
+              f"{r['seconds']:5.1f}s")
+    print()
+    print("Predicted  Observed     N")
+    for b in report["calibration"]:
+        print(f"{b['predicted']:9.1%}  {b['observed']:8.1%}  {b['n']:4.0f}")
+    print()
+    print(f"Overall Brier score {report['brier']:.4f}; {report['seconds']:.0f}s of model time.")
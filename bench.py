@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+# BENCHMARKS ON SYNTHETIC DATA
+#
+# Times the main stages of the forecast on generated inputs of increasing size,
+# so that engine changes can be evaluated without network access. Results are
+# compared against a stored baseline; any benchmark that is more than
+# TOLERANCE slower than its baseline fails the run.
+
+import os
+import sys
+import json
+import tempfile
+import argparse
+from datetime import date, timedelta
+import time
+
+import pandas as pd
+import numpy as np
+
+import cache
+import pollstore
+import priors
+import simulate
+
+STATES = ["AL", "AZ", "CA", "CO", "FL", "GA", "IL", "IN", "MA", "MI", "MN", "NC",
+          "NJ", "NY", "OH", "PA", "TN", "TX", "VA", "WA", "WI"]
+
+
+def main():
+    args = get_args()
+
+    benchmarks = {
+        "polls": bench_polls,
+        "stan": bench_stan,
+        "races": bench_races,
+        "race_data": bench_race_data,
+    }
+    selected = args.only.split(",") if args.only else list(benchmarks)
+
+    timings = {}
+    for name in selected:
+        for label, seconds in benchmarks[name](args):
+            key = f"{name}/{label}"
+            timings[key] = seconds
+            print(f"{key:<32} {seconds:>10.3f} s")
+    print()
+
+    if not os.path.isfile(args.baseline):
+        print(f"No baseline at {args.baseline}, so nothing was compared; these timings "
+              "are the new baseline.")
+    if args.update or not os.path.isfile(args.baseline):
+        baseline = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(timings)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        print(f"Baseline written to {args.baseline}.")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    failed = []
+    for key, seconds in timings.items():
+        if key not in baseline:
+            continue
+        ratio = seconds / baseline[key]
+        status = "SLOWER" if ratio > 1 + args.tolerance else "ok"
+        print(f"{key:<32} {ratio:>8.2f}x baseline  {status}")
+        if status != "ok":
+            failed.append(key)
+
+    if failed:
+        print()
+        print(f"{len(failed)} benchmark(s) regressed by more than {args.tolerance:.0%}.")
+        sys.exit(1)
+
+
+#################################
+# Benchmarks                    #
+#################################
+
+def bench_polls(args):
+    import house
+
+    for n_polls in [100, 1000, 10_000]:
+        raw = synthetic_polls(n_polls, 52)
+        yield f"N={n_polls}", best_time(lambda: house.get_polling_data(raw=raw), args.repeat)
+
+    # adding 10 polls to a store that has the rest
+    for n_polls in [1000, 10_000]:
+        raw = synthetic_polls(n_polls, 52)
+        def run():
+            store = pollstore.PollStore(house.election_day(2018))
+            store.update(raw.iloc[10:])
+            start = time.perf_counter()
+            store.update(raw)
+            store.arrays()
+            return time.perf_counter() - start
+        yield f"N={n_polls},new=10", min(run() for _ in range(args.repeat))
+
+def bench_stan(args):
+    import house
+
+    model = house.load_model(args.model_dir)
+    for n_polls, n_weeks in [(50, 13), (200, 26), (500, 52)]:
+        polls, W, M = house.get_polling_data(raw=synthetic_polls(n_polls, n_weeks))
+        data = synthetic_mcmc_data(polls, W, M)
+        run = lambda: model.sampling(data=data, chains=1, iter=args.stan_iter,
+                                     warmup=args.stan_iter // 2, seed=1, refresh=0)
+        yield f"N={len(polls)},W={W},M={M}", best_time(run, 1)
+
+def bench_races(args):
+    rng = np.random.RandomState(0)
+    means = rng.normal(-0.05, 0.25, 435)
+    sampler = simulate.factor_sampler(means, 0.002, 0.01)
+
+    for race_n in [10_000, 100_000, 1_000_000]:
+        np.random.seed(0)
+        run = lambda: simulate.simulate_races(sampler, race_n)
+        yield f"race_n={race_n}", best_time(run, args.repeat)
+
+    # variance-reduced draws, at the size that matches plain draws' precision
+    for method in ["antithetic", "sobol"]:
+        np.random.seed(0)
+        run = lambda: simulate.simulate_races(sampler, 16_384, method=method, control=True)
+        yield f"race_n=16384,{method}", best_time(run, args.repeat)
+
+def bench_race_data(args):
+    for n_districts in [435, 1740]:
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "cd_president.tsv")
+            synthetic_districts(n_districts).to_csv(filename, sep="\t", index=False)
+            # the parsed file is cached under its path, which is new each run
+            settings = dict(cache.settings)
+            cache.configure(os.path.join(tmp, "cache"))
+            try:
+                cd_vote = priors.get_pvi_data(filename)
+            finally:
+                cache.settings.update(settings)
+
+        results = {year: synthetic_results(cd_vote.race, seed=year)
+                   for year in range(2002, 2016, 2)}
+        run = lambda: priors.prepare_race_data(results=results, cd_vote=cd_vote)
+        yield f"districts={n_districts}", best_time(run, args.repeat)
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+#################################
+# Synthetic data                #
+#################################
+
+# Polls as returned by `house.fetch_polls`, spread over the `n_weeks` weeks
+# before election day.
+def synthetic_polls(n_polls, n_weeks, n_pollsters=20, year=2018, seed=0):
+    rng = np.random.RandomState(seed)
+    nov_1 = date(year, 11, 1)
+    election_day = nov_1 + timedelta(days=(1 - nov_1.weekday() + 7) % 7)
+
+    days_before = rng.randint(0, 7 * n_weeks, n_polls)
+    days_before[0] = 7 * n_weeks - 1
+    start_date = [election_day - timedelta(days=int(d)) for d in days_before]
+    end_date = [d + timedelta(days=int(k)) for d, k in zip(start_date, rng.randint(1, 5, n_polls))]
+
+    dem = rng.normal(45, 3, n_polls).round()
+    gop = rng.normal(40, 3, n_polls).round()
+    other = rng.randint(0, 5, n_polls)
+
+    return pd.DataFrame({
+        "Democrat": dem,
+        "Republican": gop,
+        "Other": other,
+        "Undecided": 100 - dem - gop - other,
+        "survey_house": [f"Pollster {k}" for k in rng.randint(0, n_pollsters, n_polls)],
+        "start_date": start_date,
+        "end_date": end_date,
+        "sample_subpopulation": rng.choice(["Likely Voters", "Registered Voters"], n_polls),
+        "mode": "Internet",
+        "partisanship": "Nonpartisan",
+        "partisan_affiliation": "None",
+        "poll_slug": [f"poll-{i}" for i in range(n_polls)],
+        "question_text": "2018 National House Vote",
+        "margin_of_error": 3.0,
+        "n_resp": rng.randint(500, 3000, n_polls),
+    })
+
+# Stan input for `house.stan`, with flat priors in place of the fitted ones.
+def synthetic_mcmc_data(polls, n_weeks, n_months):
+    sigma_cov = np.full((n_months, n_months), 0.0)
+    np.fill_diagonal(sigma_cov, 0.02**2)
+    diag = np.arange(0, n_months - 1)
+    sigma_cov[diag + 1, diag] = 0.01**2
+    sigma_cov[diag, diag+1] = 0.01**2
+
+    return {
+        "R": 435,
+        "W": n_weeks,
+        "M": n_months,
+        "N": len(polls),
+        "P": max(polls.pollster),
+        "w": polls.week.values,
+        "m": polls.month.values,
+        "n_resp": polls.n_resp.values,
+        "n_dem": polls.n_dem.values,
+        "p": polls.pollster.values,
+        "alpha_n_prior": np.zeros(n_months),
+        "sigma_n_prior": sigma_cov,
+        "mu_prior": 0.05,
+        "mu_mse": 0.03,
+    }
+
+# Districts shaped like data/cd_president.tsv.
+def synthetic_districts(n_districts, seed=0):
+    rng = np.random.RandomState(seed)
+    state = [STATES[i % len(STATES)] for i in range(n_districts)]
+    district = [i // len(STATES) + 1 for i in range(n_districts)]
+
+    data = {
+        "state": state,
+        "district": district,
+        "race": [f"{s}-{d:02}" for s, d in zip(state, district)],
+    }
+    lean = rng.normal(0, 15, n_districts)
+    for year in ["16", "12", "08", "04", "00"]:
+        dem = np.clip(48 + lean + rng.normal(0, 3, n_districts), 5, 95).round()
+        data[f"dem_{year}"] = dem
+        data[f"gop_{year}"] = 97 - dem
+
+    return pd.DataFrame(data)
+
+# Candidates in each race, shaped like the output of `priors.get_results`.
+def synthetic_results(races, seed=0):
+    rng = np.random.RandomState(seed)
+    parties = ["D", "R", "DEM", "REP", "DFL", "D/WF", "R/C", "LIB", "GRN", "IND"]
+    weights = np.array([30, 30, 5, 5, 1, 2, 2, 10, 5, 10]) / 100
+
+    n = rng.randint(1, 5, len(races))
+    pct = rng.uniform(1, 60, n.sum())
+    return pd.DataFrame({
+        "race": np.repeat(np.asarray(races), n),
+        "party": rng.choice(parties, n.sum(), p=weights),
+        "general_pct": pct,
+        "incumbent": rng.rand(n.sum()) < 0.3,
+    })
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Benchmark the forecast on synthetic data.",
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--only", type=str, nargs="?", default=None,
+            help="Comma-separated benchmarks to run (polls, stan, races, race_data).")
+    parser.add_argument("--baseline", type=str, nargs="?", default="bench_baseline.json",
+            help="File in which baseline timings are stored.")
+    parser.add_argument("--update", action="store_true",
+            help="Record these timings as the new baseline.")
+    parser.add_argument("--tolerance", type=float, nargs="?", default=0.25,
+            help="Fraction by which a benchmark may exceed its baseline.")
+    parser.add_argument("--repeat", type=int, nargs="?", default=3,
+            help="Repetitions of each benchmark (the fastest is kept).")
+    parser.add_argument("--stan_iter", type=int, nargs="?", default=1000,
+            help="MCMC iterations for the Stan benchmarks.")
+    parser.add_argument("--model_dir", type=str, nargs="?", default="models",
+            help="Directory in which models are stored.")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# ON-DISK CACHE FOR NETWORK FETCHES
+
+import os
+import pickle
+import hashlib
+import time
+import tempfile
+from urllib.request import urlopen
+
+# the process's umask, for the permissions of written files
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# Seconds a cached response stays fresh, by source. None means forever.
+SOURCE_TTL = {
+    "pollster": 60 * 60,
+    "wikipedia": 24 * 60 * 60,
+    "fred": 30 * 24 * 60 * 60,
+    "openelections": None,
+}
+
+settings = {
+    "cache_dir": "cache",
+    "fixture_dir": None,
+    "offline": False,
+}
+
+
+# In offline mode nothing is fetched: responses come from the cache, whatever
+# their age, or from `fixture_dir`, which has the same layout as the cache.
+def configure(cache_dir="cache", offline=False, fixture_dir=None):
+    settings["cache_dir"] = cache_dir
+    settings["offline"] = offline
+    settings["fixture_dir"] = fixture_dir
+
+
+# Raw bytes at `url`.
+def fetch_url(url, source):
+    return cached_call(source, url, lambda: urlopen(url).read(), raw=True)
+
+# Result of calling `func()`, stored under `key`. Unless `raw`, the result is
+# pickled.
+def cached_call(source, key, func, raw=False):
+    filename = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    path = os.path.join(settings["cache_dir"], source, filename)
+    ttl = SOURCE_TTL.get(source)
+
+    if os.path.isfile(path):
+        fresh = ttl is None or time.time() - os.path.getmtime(path) < ttl
+        if fresh or settings["offline"]:
+            return read(path, raw)
+
+    if settings["offline"]:
+        if settings["fixture_dir"] is not None:
+            fixture = os.path.join(settings["fixture_dir"], source, filename)
+            if os.path.isfile(fixture):
+                return read(fixture, raw)
+        raise FileNotFoundError(f"No cached response for {key} ({source}) "
+                                "and fetching is disabled in offline mode.")
+
+    value = func()
+    write(path, value if raw else pickle.dumps(value))
+    return value
+
+def read(path, raw):
+    with open(path, "rb") as f:
+        data = f.read()
+    return data if raw else pickle.loads(data)
+
+# write to a temporary file first so concurrent readers never see a partial file
+# Write `data` (bytes) to `path` atomically, through a temporary file of its own
+# for each writer, whether process or thread.
+def write(path, data):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # temporary files are private; give it the permissions of a new file
+        os.chmod(tmp, 0o666 & ~UMASK)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
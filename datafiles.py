@@ -0,0 +1,47 @@
+# LOADING FILES FROM data/
+#
+# Files are parsed with only the columns and types we need, then passed through
+# an optional `prepare` function. The result is kept in memory for the rest of
+# the process and pickled to the cache directory, and both copies are reused
+# until the file's modification time or size (or the loading code) changes.
+
+import os
+import pickle
+import hashlib
+import inspect
+
+import pandas as pd
+
+import cache
+
+memo = {}
+
+
+def load(filename, columns, prepare=None):
+    stat = os.stat(filename)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    h = hashlib.sha256(repr((os.path.abspath(filename), columns)).encode("utf-8"))
+    if prepare is not None:
+        h.update(inspect.getsource(prepare).encode("utf-8"))
+    key = h.hexdigest()
+
+    if key in memo and memo[key][0] == stamp:
+        return memo[key][1].copy()
+
+    path = os.path.join(cache.settings["cache_dir"], "data",
+                        f"{os.path.basename(filename)}.{key[:16]}.pkl")
+    if os.path.isfile(path):
+        cached_stamp, data = pd.read_pickle(path)
+        if cached_stamp == stamp:
+            memo[key] = (stamp, data)
+            return data.copy()
+
+    data = pd.read_table(filename, usecols=list(columns), dtype=columns)
+    if prepare is not None:
+        data = prepare(data)
+
+    cache.write(path, pickle.dumps((stamp, data), protocol=pickle.HIGHEST_PROTOCOL))
+
+    memo[key] = (stamp, data)
+    return data.copy()
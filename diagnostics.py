@@ -0,0 +1,104 @@
+# CONVERGENCE DIAGNOSTICS
+#
+# Rank-normalized split R-hat and bulk and tail effective sample sizes, as in
+# Vehtari et al. (2021), "Rank-normalization, folding, and localization: an
+# improved R-hat for assessing convergence of MCMC". Draws are arrays of shape
+# (chains, iterations) for one scalar quantity, as from `posterior.chain_draws`.
+
+import numpy as np
+from scipy.special import ndtri
+
+
+# Worst R-hat, smallest bulk and tail ESS, and the number of quantities
+# checked, over every element of each array in `draws`.
+def summarize(draws):
+    rhats, bulk, tail = [], [], []
+    for values in draws.values():
+        values = np.asarray(values, dtype=float)
+        values = values.reshape(*values.shape[:2], -1)
+        for j in range(values.shape[2]):
+            x = values[:, :, j]
+            rhats.append(rhat(x))
+            bulk.append(ess_bulk(x))
+            tail.append(ess_tail(x))
+    return {
+        "rhat": float(np.nanmax(rhats)),
+        "ess_bulk": float(np.nanmin(bulk)),
+        "ess_tail": float(np.nanmin(tail)),
+        "n_checked": len(rhats),
+    }
+
+def rhat(x):
+    split = split_chains(x)
+    folded = np.abs(split - np.median(split))
+    return max(basic_rhat(rank_normalize(split)), basic_rhat(rank_normalize(folded)))
+
+def ess_bulk(x):
+    return ess(rank_normalize(split_chains(x)))
+
+# The smaller ESS of the 5% and 95% quantiles.
+def ess_tail(x):
+    split = split_chains(x)
+    low, high = np.quantile(split, [0.05, 0.95])
+    return min(ess((split <= low).astype(float)), ess((split <= high).astype(float)))
+
+
+def split_chains(x):
+    half = x.shape[1] // 2
+    return np.vstack([x[:, :half], x[:, -half:]])
+
+def rank_normalize(x):
+    ranks = np.empty(x.size)
+    order = np.argsort(x, axis=None, kind="stable")
+    ranks[order] = np.arange(1, x.size + 1)
+    # average the ranks of ties
+    flat = x.ravel()
+    _, inverse, counts = np.unique(flat, return_inverse=True, return_counts=True)
+    if np.any(counts > 1):
+        ranks = np.bincount(inverse, weights=ranks)[inverse] / counts[inverse]
+    return ndtri((ranks - 3 / 8) / (x.size + 1 / 4)).reshape(x.shape)
+
+def basic_rhat(x):
+    m, n = x.shape
+    within = np.mean(np.var(x, axis=1, ddof=1))
+    between = n * np.var(np.mean(x, axis=1), ddof=1)
+    if within == 0:
+        return np.nan if between > 0 else 1.0
+    return float(np.sqrt(((n - 1) / n * within + between / n) / within))
+
+# Effective sample size from within-chain autocorrelations combined across
+# chains, truncated by Geyer's initial monotone sequence.
+def ess(x):
+    m, n = x.shape
+    if n < 4 or np.all(x == x.flat[0]):
+        return np.nan
+
+    acov = autocovariance(x)
+    mean_var = np.mean(acov[:, 0]) * n / (n - 1)
+    var_plus = mean_var * (n - 1) / n
+    if m > 1:
+        var_plus += np.var(np.mean(x, axis=1), ddof=1)
+    rho = 1 - (mean_var - np.mean(acov, axis=0)) / var_plus
+    rho[0] = 1
+
+    # sum autocorrelations in pairs while the pair sums stay positive,
+    # forcing them to decrease
+    total = 0
+    prev = np.inf
+    for t in range(0, n - 1, 2):
+        pair = rho[t] + rho[t + 1]
+        if pair < 0:
+            break
+        pair = min(pair, prev)
+        total += pair
+        prev = pair
+
+    tau = max(-1 + 2 * total, 1 / np.log10(m * n))
+    return float(m * n / tau)
+
+def autocovariance(x):
+    n = x.shape[1]
+    size = 2 ** int(np.ceil(np.log2(2 * n)))
+    centered = x - np.mean(x, axis=1, keepdims=True)
+    f = np.fft.rfft(centered, size, axis=1)
+    return np.fft.irfft(f * np.conj(f), size, axis=1)[:, :n] / n
@@ -0,0 +1,74 @@
+# STORED POSTERIOR AND SIMULATION DRAWS
+#
+# Each run's draws are kept in their own directory, named for the run date, as
+# raw binary arrays with a manifest giving each array's dtype and shape, along
+# with labels such as district names. Arrays are opened as read-only memory
+# maps, so nothing is read from disk until it is sliced.
+
+import os
+import json
+from datetime import datetime
+
+import numpy as np
+
+MANIFEST = "manifest.json"
+
+
+def run_path(draws_dir, run_date):
+    return os.path.join(draws_dir, f"{run_date:%Y-%m-%d}")
+
+class DrawWriter:
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.arrays = {}
+
+    # Write a complete array.
+    def save(self, name, values, dtype="float64"):
+        values = np.ascontiguousarray(values, dtype=dtype)
+        values.tofile(self.filename(name))
+        self.arrays[name] = {"dtype": values.dtype.str, "shape": list(values.shape)}
+
+    # Add rows to an array, which can be built up a chunk at a time.
+    def append(self, name, chunk, dtype="float32"):
+        chunk = np.ascontiguousarray(chunk, dtype=dtype)
+        if name not in self.arrays:
+            open(self.filename(name), "wb").close()
+            self.arrays[name] = {"dtype": chunk.dtype.str, "shape": [0, *chunk.shape[1:]]}
+        with open(self.filename(name), "ab") as f:
+            chunk.tofile(f)
+        self.arrays[name]["shape"][0] += len(chunk)
+
+    # Write the manifest; `labels` name the entries along array axes, e.g.
+    # {"districts": [...]}.
+    def close(self, labels=None, **meta):
+        manifest = {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "arrays": self.arrays,
+            "labels": labels or {},
+            **meta,
+        }
+        with open(os.path.join(self.path, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=4)
+
+    def filename(self, name):
+        return os.path.join(self.path, f"{name}.bin")
+
+
+def list_runs(draws_dir="draws"):
+    if not os.path.isdir(draws_dir):
+        return []
+    return sorted(d for d in os.listdir(draws_dir)
+                  if os.path.isfile(os.path.join(draws_dir, d, MANIFEST)))
+
+def load_manifest(path):
+    with open(os.path.join(path, MANIFEST)) as f:
+        return json.load(f)
+
+# Memory maps of the arrays stored for a run, e.g.
+#   open_run(run_path("draws", datetime(2018, 7, 15)))["results"][:, 10]
+def open_run(path, names=None):
+    arrays = load_manifest(path)["arrays"]
+    return {name: np.memmap(os.path.join(path, f"{name}.bin"), mode="r",
+                            dtype=np.dtype(info["dtype"]), shape=tuple(info["shape"]))
+            for name, info in arrays.items() if names is None or name in names}
@@ -0,0 +1,94 @@
+# APPEND-ONLY RUN HISTORY
+#
+# Runs are appended to a log of length-prefixed JSON records, and each record's
+# time and offset to an index of fixed-size entries beside it, so logging a run
+# costs the same however long the history is. Appends hold an exclusive lock
+# on the log, so concurrent processes can log safely. When several records
+# share a time, the latest one wins. `compact` writes the JSON list the site
+# reads.
+
+import os
+import json
+import fcntl
+import struct
+
+import cache
+
+HEADER = struct.Struct("<I")
+INDEX_ENTRY = struct.Struct("<qQ")
+
+
+def append(entries, log_path):
+    records = [json.dumps(entry, separators=(",", ":")).encode("utf-8") for entry in entries]
+
+    with open(log_path, "ab") as log, open(index_path(log_path), "ab") as index:
+        fcntl.flock(log, fcntl.LOCK_EX)
+        try:
+            offset = log.seek(0, os.SEEK_END)
+            for entry, record in zip(entries, records):
+                log.write(HEADER.pack(len(record)) + record)
+                index.write(INDEX_ENTRY.pack(int(entry["time"]), offset))
+                offset += HEADER.size + len(record)
+            log.flush()
+            index.flush()
+        finally:
+            fcntl.flock(log, fcntl.LOCK_UN)
+
+# Offset of the latest record for each time.
+def read_index(log_path):
+    path = index_path(log_path)
+    if not os.path.isfile(path):
+        rebuild_index(log_path)
+    with open(path, "rb") as f:
+        data = f.read()
+
+    usable = len(data) - len(data) % INDEX_ENTRY.size
+    return dict(INDEX_ENTRY.iter_unpack(data[:usable]))
+
+# Entries with `start <= time <= end` (in ms; either may be None), in time order.
+def query(log_path, start=None, end=None):
+    if not os.path.isfile(log_path):
+        return []
+    index = read_index(log_path)
+    times = sorted(t for t in index
+                   if (start is None or t >= start) and (end is None or t <= end))
+
+    entries = []
+    with open(log_path, "rb") as log:
+        for t in times:
+            log.seek(index[t])
+            size, = HEADER.unpack(log.read(HEADER.size))
+            entries.append(json.loads(log.read(size)))
+    return entries
+
+def compact(log_path, json_path):
+    entries = query(log_path)
+    cache.write(json_path, json.dumps(entries).encode("utf-8"))
+    return len(entries)
+
+# Start a log from an existing JSON history.
+def import_json(json_path, log_path):
+    with open(json_path) as f:
+        append(json.load(f), log_path)
+
+
+def index_path(log_path):
+    return log_path + ".idx"
+
+def rebuild_index(log_path):
+    entries = []
+    with open(log_path, "rb") as log:
+        offset = 0
+        while True:
+            header = log.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            size, = HEADER.unpack(header)
+            record = log.read(size)
+            if len(record) < size: # partial write
+                break
+            entries.append(INDEX_ENTRY.pack(int(json.loads(record)["time"]), offset))
+            offset += HEADER.size + size
+
+    with open(index_path(log_path), "wb") as f:
+        f.write(b"".join(entries))
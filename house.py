@@ -16,185 +16,343 @@ import argparse
 import json
 from datetime import date, datetime, timedelta
 import time
-from urllib.request import urlopen as fetch
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning) 
 warnings.filterwarnings("ignore", category=FutureWarning) 
 
-from bs4 import BeautifulSoup
-import pollster
-pollster = pollster.Api()
-
+# PyStan, statsmodels (through priors), BeautifulSoup, pollster and us are slow
+# to import, so they are imported only where they are used.
 import pandas as pd
 import numpy as np
-from pystan import StanModel 
-import us
 
-import priors
+import approx
+import artifacts
+import cache
+import draws
+import history
+import output
+import pollstore
+import posterior
+import scenarios
+import simulate
+import timing
+import warm_start
+
+
+CURRENT_SEATS = 194
+
+# The cycle being forecast: covariates for the national prior (as in
+# priors.national_prior_data), the columns of district lean and presidential
+# margin in `cd_vote` to use, the seats Democrats hold going in, and the seats
+# needed for a majority.
+CYCLE = {"year": 2018, "INC": -1, "PRES": -1, "MID": 1, "pvi": "pvi_2018",
+         "adj": "pres_margin_16", "seats": CURRENT_SEATS, "majority": 218}
 
 
 def main():
     args = get_args()
+    cache.configure(args.cache_dir, offline=args.offline, fixture_dir=args.fixture_dir)
 
-    election_day = datetime(2018, 11, 6)
-    current_seats = 194
+    # these only read stored results, so skip loading models and data
+    if args.command == "summary":
+        show_summary(args)
+        return
+    if args.command == "output":
+        regenerate_output(args)
+        return
 
     print("===========================================")
     print("  2018 U.S. HOUSE PREDICTIONS              ")
     print("===========================================")
     print()
 
-    #################################
-    # Load prior models             #
-    #################################
-    nat_prior = priors.get_national_prior(model_dir=args.model_dir)
-    race_prior = priors.get_race_prior(model_dir=args.model_dir)
-    bias_prior = priors.get_bias_prior(recalculate=True, model_dir=args.model_dir)
+    if args.serve:
+        import server
+        server.serve(args)
+        return
+
+    if args.command == "backtest":
+        import backtest
+        backtest.run(args)
+        write_profile(args)
+        return
+
+    # a single forecast can sample the national model while race data is
+    # fetched; backfills and sweeps share the inputs with worker processes
+    inputs = load_inputs(args, wait=bool(args.backfill or args.sweep))
+
+    if args.backfill:
+        backfill(args, inputs)
+        write_profile(args)
+        return
 
+    if args.sweep:
+        import sensitivity
+        sensitivity.sweep(args, inputs)
+        write_profile(args)
+        return
+
+    output_data = forecast(args.date or datetime.now(), inputs, args)
+
+    print()
+    print_summary(output_data)
+    print()
 
     #################################
-    # Organize data for prediction  #
+    # Output predictions            #
     #################################
 
-    approvals = priors.get_approvals_data()
-    cd_vote = priors.get_pvi_data()
+    if args.dry: 
+        write_profile(args)
+        exit(0)
 
-    polls, n_weeks, n_months = get_polling_data(max_date = args.date)
+    timing.start("output")
+    write_output(output_data, args)
 
-    if args.date >= datetime(2018, 6, 1):
-        appr_slice = approvals[(approvals.date > date(2018, 1, 1))
-                                & (approvals.date < date(2018, 6, 1))]
-    else: # use last six months
-        ago = args.date - timedelta(6 * 365/12)
-        appr_slice = approvals[(approvals.date > ago) & (approvals.date < args.date)]
+    if args.profile and args.profile_history:
+        timing.stop()
+        output_data["profile"] = {s["stage"]: s["wall"] for s in timing.stages}
 
-    nat_prior_data = [{
-        "APPR": appr_slice.approval.mean(),
-        "INC": -1,
-        "PRES": -1,
-        "MID": 1,
-    }]
-    nat_prediction = nat_prior.predict(nat_prior_data)[0]
+    log_history([output_data], args)
+    save_results([output_data], args)
 
-    # create covariance matrix for national polling error
-    sigma_cov = np.full((n_months, n_months), 0.0)
-    np.fill_diagonal(sigma_cov, bias_prior.mse_resid / 100**2)
-    diag = np.arange(0, n_months - 1)
-    sigma_cov[diag + 1, diag] = bias_prior.step_var
-    sigma_cov[diag, diag+1] = bias_prior.step_var
+    write_profile(args)
+    print()
 
-    mcmc_data = {
-        "R": 435,
-        "W": n_weeks,
-        "M": n_months,
-        "N": len(polls),
-        "P": max(polls.pollster),
-        "w": polls.week.values,
-        "m": polls.month.values,
-        "n_resp": polls.n_resp.values,
-        "n_dem": polls.n_dem.values,
-        "p": polls.pollster.values,
-        "alpha_n_prior": bias_prior.predict({"months": range(n_months-1, -1, -1)}).values / 100,
-        "sigma_n_prior": sigma_cov,
-        "mu_prior": nat_prediction / 100,
-        "mu_mse": math.sqrt(nat_prior.mse_resid) / 100,
+
+# Keep the full output of each run, by run date, so that output files can be
+# regenerated without rerunning the model.
+def save_results(entries, args):
+    os.makedirs(args.results_dir, exist_ok=True)
+    for output_data in entries:
+        run_date = datetime.fromtimestamp(output_data["time"] / 1000)
+        with open(os.path.join(args.results_dir, f"{run_date:%Y-%m-%d}.pkl"), "wb") as f:
+            pickle.dump(output_data, f)
+
+# Stored results for `args.date`, or the latest if no date was given.
+def load_results(args):
+    if args.date is not None:
+        filename = f"{args.date:%Y-%m-%d}.pkl"
+    else:
+        stored = sorted(os.listdir(args.results_dir)) if os.path.isdir(args.results_dir) else []
+        if not stored:
+            return None
+        filename = stored[-1]
+
+    path = os.path.join(args.results_dir, filename)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+def show_summary(args):
+    output_data = load_results(args)
+    if output_data is None:
+        print(f"No stored results in {args.results_dir}.")
+        exit(1)
+
+    print(f"As of {datetime.fromtimestamp(output_data['time'] / 1000):%Y-%m-%d %H:%M}:")
+    print_summary(output_data)
+
+def regenerate_output(args):
+    output_data = load_results(args)
+    if output_data is None:
+        print(f"No stored results in {args.results_dir}.")
+        exit(1)
+
+    write_output(output_data, args)
+
+def write_profile(args):
+    if not args.profile:
+        return
+
+    report = timing.report()
+    print()
+    timing.print_report()
+    with open(args.profile, "w") as f:
+        json.dump(report, f, indent=4)
+        print(f"Profile written to {args.profile}.")
+
+# Work done by the sampler, summed over chains.
+def sampler_stats(fits):
+    params = [(p, fit.sim["warmup"]) for fit in fits for p in fit.get_sampler_params(inc_warmup=True)]
+    return {
+        "chains": len(fits[0].get_sampler_params()),
+        "gradient_evals": int(sum(np.sum(p["n_leapfrog__"]) for p, _ in params)),
+        "divergent": int(sum(np.sum(p["divergent__"][warmup:]) for p, warmup in params)),
+        "max_treedepth": int(max(np.max(p["treedepth__"]) for p, _ in params)),
+        "mean_accept": float(np.mean([np.mean(p["accept_stat__"][warmup:])
+                                      for p, warmup in params])),
     }
 
 
+# Everything that does not depend on the date being modeled: prior models, the
+# compiled Stan model, and scraped or downloaded data. Downloads and scraping
+# run in threads while the priors and model load. With `wait=False`, the data
+# only needed to predict races (district leans, incumbents and retirements) is
+# left as futures, so sampling the national model can start while it is still
+# being fetched; `forecast` waits for it before predicting races.
+def load_inputs(args, wait=True):
+    import priors
+
+    fetches = ThreadPoolExecutor(max_workers=5)
+    national = {
+        "approvals": fetches.submit(priors.get_approvals_data),
+        "polls": fetches.submit(load_polls),
+    }
+    races = {
+        "cd_vote": fetches.submit(priors.get_pvi_data),
+        "incumbents": fetches.submit(get_incumbency),
+        "not_running": fetches.submit(find_not_running, 2018),
+    }
+    fetches.shutdown(wait=False)
+
     #################################
-    # Compile and run STAN model    #
+    # Load prior models             #
     #################################
+    timing.start("load priors")
+    nat_prior = priors.get_national_prior(model_dir=args.model_dir)
+    race_prior = priors.get_race_prior(model_dir=args.model_dir)
+    bias_prior = priors.get_bias_prior(model_dir=args.model_dir)
+
+    timing.start("load model")
+    model = load_model(args.model_dir, args.recompile)
+
+    timing.start("fetch data")
+    inputs = {
+        "nat_prior": nat_prior,
+        "race_prior": race_prior,
+        "bias_prior": bias_prior,
+        "model": model,
+        **{k: f.result() for k, f in national.items()},
+        **races,
+        "cycle": CYCLE,
+    }
+    return fetched(inputs) if wait else inputs
 
-    filename = "house_stan.pkl"
-    path = os.path.join(args.model_dir, filename)
+# `inputs` with any fetches still running waited for.
+def fetched(inputs):
+    return {k: v.result() if isinstance(v, Future) else v for k, v in inputs.items()}
 
-    if os.path.isfile(path) and not args.recompile:
+def load_model(model_dir="models", recompile=False, filename="house_stan.pkl"):
+    path = os.path.join(model_dir, filename)
+    key = artifacts.artifact_key(files=["house.stan"], code=[load_model], libraries=["pystan"])
+
+    if artifacts.is_current(path, key) and not recompile:
         with open(path, "rb") as f:
             model = pickle.load(f)
     else:
+        from pystan import StanModel
         model = StanModel(file="house.stan")
         with open(path, "wb") as f:
             pickle.dump(model, f)
+        artifacts.record(path, key)
 
-
-    fit = model.sampling(data=mcmc_data, chains=1, iter=args.nat_n, 
-            warmup=args.nat_n // 8)
+    return model
 
 
+# Run the national model and race simulations as of `max_date`, returning the
+# data written to the output file.
+def forecast(max_date, inputs, args):
     #################################
-    # Extract results               #
+    # Organize data for prediction  #
     #################################
+    timing.start("organize data")
 
-    mu_samples = fit.extract("mu")["mu"]
-    y = 100 * np.mean(mu_samples, axis=0)
-    err_y = 100 * np.std(mu_samples, axis=0)
-    weeks = pd.date_range(end=election_day, periods=n_weeks, freq="W")
-    weeks = weeks.strftime("%Y-%m-%d")
-
-
-    alpha_samples = fit.extract("alpha_n")["alpha_n"]
-    alpha = 100 * np.mean(alpha_samples, axis=0)
-    err_alpha = 2 * 100 * np.std(alpha_samples, axis=0)
+    mcmc_data = national_data(max_date, inputs)
+    n_weeks = mcmc_data["W"]
 
 
     #################################
-    # Predict individual races      #
+    # Run STAN model                #
     #################################
+    timing.start("run stan")
 
-    incumbents = get_incumbency()
-    not_running = find_not_running(2018)
+    reference_path = os.path.join(args.model_dir, "nuts_summary.pkl")
 
-    race_prior_data = []
-    races = incumbents.district.unique()
-    incumbent_series = []
-    for race in races:
-        incumbent_series.append(incumbents.loc[race].incumbent)
-        race_prior_data.append({ 
-            "NAT": y[-1],
-            "INC": 0 if race in not_running else incumbents.loc[race].incumbent,
-            "PVI": cd_vote.loc[race].pvi_2018,
-            "ADJ": cd_vote.loc[race].pres_margin_16,
-            "MID": 1,
-            "PRES": -1,
-        })
-
-    race_predictions = race_prior.predict(race_prior_data).values / 100
+    if args.approx:
+        fits, diag = None, None
+        samples = approx.draw(inputs["model"], mcmc_data, args.approx, args.approx_n)
+        summary = posterior.summarize_draws(samples)
+        comparison = approx.compare(reference_path, samples)
+    else:
+        # only keep whole draws if they are saved
+        keep = ["mu", "alpha_n"] if args.save_draws and not args.dry else []
+        fits, samples, diag = run_nuts(inputs["model"], mcmc_data, args, pars=keep)
+        summary = posterior.summarize(fits, ["mu", "alpha_n"])
+        comparison = None
+        # forecasts in worker processes (e.g. the server's) run in parallel,
+        # so only the main process keeps the reference
+        if not args.dry and not args.backfill and not _worker_state:
+            approx.save_reference(reference_path, summary)
 
-    # add in variance from national model
-    addl_var = (err_y[-1] / 100)**2
-    cov_matrix = np.full((435, 435), race_prior.mse_resid/100**2 + addl_var)
-    np.fill_diagonal(cov_matrix, race_prior.dist_var/100**2 + addl_var)
 
-    results = np.random.multivariate_normal(race_predictions, cov_matrix, args.race_n)
+    #################################
+    # Extract results               #
+    #################################
+    timing.start("extract results")
+    if fits is not None:
+        diag.update(sampler_stats(fits))
+        timing.note("stan", diag)
+
+    y = 100 * summary["mu"]["mean"]
+    err_y = 100 * summary["mu"]["std"]
+    weeks = pd.date_range(end=election_day(inputs["cycle"]["year"]), periods=n_weeks, freq="W")
+    weeks = weeks.strftime("%Y-%m-%d")
 
-    expected = results.mean(axis=0)
-    expected_std = results.std(axis=0)
-    prob_district = np.mean((np.sign(results) + 1) / 2, axis=0)
-    seats = np.sum((np.sign(results) + 1) / 2, axis=1).astype(int)
-    seats_hist = np.bincount(seats, minlength=436) / len(seats)
-    prob = np.mean(seats >= 218)
-    gain = np.median(seats) - current_seats
 
-    print()
-    print(f"National Prediction: {'D' if y[-1] >= 0 else 'R'}+{abs(y[-1]):.1f}%")
-    print(f"Democrats have a {prob:.0%} chance of retaking the House.")
-    print(f"They are expected to {'gain' if gain > 0 else 'lose'} {abs(gain):.0f} seats.")
-    print()
+    alpha = 100 * summary["alpha_n"]["mean"]
+    err_alpha = 2 * 100 * summary["alpha_n"]["std"]
 
 
     #################################
-    # Output predictions            #
+    # Predict individual races      #
     #################################
+    if any(isinstance(v, Future) for v in inputs.values()):
+        timing.start("wait for data")
+        inputs = fetched(inputs)
+
+    timing.start("predict races")
+
+    races, incumbent_series, race_predictions = race_inputs(y[-1], inputs)
+    sampler = race_sampler(race_predictions, (err_y[-1] / 100)**2, races, inputs, args)
+
+    writer = None
+    sinks = []
+    if (args.save_draws or args.save_scenarios) and not args.dry:
+        writer = draws.DrawWriter(draws.run_path(args.draws_dir, max_date))
+    if writer is not None and args.save_draws:
+        writer.save("mu", samples["mu"])
+        writer.save("alpha_n", samples["alpha_n"])
+        writer.save("race_predictions", race_predictions)
+        sinks.append(lambda chunk: writer.append("results", chunk))
+    if writer is not None and args.save_scenarios:
+        recorder = scenarios.ScenarioRecorder(race_predictions, y[-1])
+        sinks.append(recorder.add)
+
+    sim = simulate.simulate_races(sampler,
+            args.race_n, chunk_size=args.chunk_size, current_seats=inputs["cycle"]["seats"],
+            majority=inputs["cycle"]["majority"],
+            target_se=args.target_se, method=args.sim_method, control=args.control_variates,
+            sink=(lambda chunk: [sink(chunk) for sink in sinks]) if sinks else None)
+
+    if writer is not None:
+        if args.save_scenarios:
+            recorder.save(writer)
+        writer.close(labels={"districts": list(races), "weeks": list(weeks)},
+                     time=int(1000 * max_date.timestamp()))
 
-    if args.dry: 
-        exit(0)
 
-    timestamp = int(1000 * args.date.timestamp())
-    
+    #################################
+    # Collect predictions           #
+    #################################
+    timing.start("collect output")
+
     district_data = pd.DataFrame({
-            "margin": expected,
-            "std": expected_std,
-            "prob": prob_district,
+            "margin": sim["margin"],
+            "std": sim["std"],
+            "prob": sim["prob_district"],
             "district": races,
             "incumbent": incumbent_series,
         })
@@ -203,78 +361,324 @@ def main():
             "std": err_y,
             "weeks": weeks,
         })
-    output_data = {
-            "time": timestamp,
-            "prob": prob,
-            "gain": gain,
-            "seats": np.median(seats),
-            "seats_min": np.percentile(seats, 10),
-            "seats_max": np.percentile(seats, 90),
-            "seats_dist": seats_hist.tolist(),
-            "districts": district_data.to_dict("records"),
-            "generic": nat_data.to_dict("records"),
+
+    return {
+            "time": int(1000 * max_date.timestamp()),
+            "prob": sim["prob"],
+            "gain": sim["gain"],
+            "seats": sim["seats"],
+            "seats_min": sim["seats_min"],
+            "seats_max": sim["seats_max"],
+            "seats_dist": sim["seats_hist"].tolist(),
+            "districts": district_data,
+            "generic": nat_data,
             "scenarios": {
-                "dem_gain": sum(seats > current_seats) / len(seats),
-                "gop_gain": sum(seats < current_seats) / len(seats),
-                }
+                "dem_gain": sim["dem_gain"],
+                "gop_gain": sim["gop_gain"],
+                },
+            "sim_n": sim["n"],
+            "sim_method": args.sim_method + ("+control" if args.control_variates else ""),
+            "sim_se": sim["se"],
+            **({"approx": {"method": args.approx, "vs_nuts": comparison}} if args.approx else {}),
+            **({"diagnostics": diag} if diag is not None else {}),
             }
 
-    with open(args.output_file, "w") as f:
-        json.dump(output_data, f)
-        print(f"Data written to {args.output_file}.")
+def write_output(output_data, args):
+    data = output.format_output(output_data, args.output_format, args.precision)
+    output.write_output(data, args.output_file, compress=not args.no_compress)
+    print(f"Data written to {args.output_file}.")
 
-    # History
-    if os.path.isfile(args.history_file):
-        with open(args.history_file, "rb") as f:
-            history = json.load(f)
-    else:
-        history = []
+# Data for the national model as of `max_date`.
+def national_data(max_date, inputs):
+    nat_prior = inputs["nat_prior"]
+    bias_prior = inputs["bias_prior"]
+    approvals = inputs["approvals"]
+
+    polls = inputs["polls"].arrays(max_date)
+    n_months = polls["M"]
+
+    cycle = inputs["cycle"]
+    if max_date >= datetime(cycle["year"], 6, 1):
+        appr_slice = approvals[(approvals.date > pd.Timestamp(cycle["year"], 1, 1))
+                                & (approvals.date < pd.Timestamp(cycle["year"], 6, 1))]
+    else: # use last six months
+        ago = max_date - timedelta(6 * 365/12)
+        appr_slice = approvals[(approvals.date > ago) & (approvals.date < max_date)]
+
+    nat_prior_data = [{
+        "APPR": appr_slice.approval.mean(),
+        "INC": cycle["INC"],
+        "PRES": cycle["PRES"],
+        "MID": cycle["MID"],
+    }]
+    nat_prediction = nat_prior.predict(nat_prior_data)[0]
 
-    history.append({
-            "time": timestamp,
-            "prob": prob,
-            "gain": gain,
-        });
-    with open(args.history_file, "w") as f:
-        json.dump(history, f)
-        print(f"Run logged to {args.history_file}.")
+    return {
+        "R": 435,
+        **polls,
+        "alpha_n_prior": bias_prior.predict({"months": range(n_months-1, -1, -1)}).values / 100,
+        "sigma_n_prior": bias_covariance(n_months, bias_prior.mse_resid / 100**2,
+                                         bias_prior.step_var),
+        "mu_prior": nat_prediction / 100,
+        "mu_mse": math.sqrt(nat_prior.mse_resid) / 100,
+    }
 
+# Covariance matrix for national polling error, with month-to-month covariance.
+def bias_covariance(n_months, var, step_var):
+    sigma_cov = np.full((n_months, n_months), 0.0)
+    np.fill_diagonal(sigma_cov, var)
+    diag = np.arange(0, n_months - 1)
+    sigma_cov[diag + 1, diag] = step_var
+    sigma_cov[diag, diag+1] = step_var
+    return sigma_cov
+
+# District names, their incumbents' parties, and predicted margins given the
+# national margin `nat_margin` (in points).
+def race_inputs(nat_margin, inputs):
+    race_prior = inputs["race_prior"]
+    cd_vote = inputs["cd_vote"]
+    incumbents = inputs["incumbents"]
+    not_running = inputs["not_running"]
+    cycle = inputs["cycle"]
+
+    race_prior_data = []
+    races = incumbents.district.unique()
+    incumbent_series = []
+    for race in races:
+        incumbent_series.append(incumbents.loc[race].incumbent)
+        race_prior_data.append({ 
+            "NAT": nat_margin,
+            "INC": 0 if race in not_running else incumbents.loc[race].incumbent,
+            "PVI": cd_vote.loc[race, cycle["pvi"]],
+            "ADJ": cd_vote.loc[race, cycle["adj"]],
+            "MID": cycle["MID"],
+            "PRES": cycle["PRES"],
+        })
+
+    race_predictions = race_prior.predict(race_prior_data).values / 100
+
+    return races, incumbent_series, race_predictions
+
+# Sampler for race margins, adding `nat_var` (the variance of the national
+# margin) to the race prior's error variances. `mse_resid` and `dist_var`
+# override the race prior's, in squared points.
+def race_sampler(race_predictions, nat_var, races, inputs, args, mse_resid=None, dist_var=None):
+    race_prior = inputs["race_prior"]
+    cd_vote = inputs["cd_vote"]
+    mse_resid = race_prior.mse_resid if mse_resid is None else mse_resid
+    dist_var = race_prior.dist_var if dist_var is None else dist_var
+
+    # add in variance from national model
+    addl_var = nat_var
+    common_var = mse_resid/100**2 + addl_var
+    dist_var = dist_var/100**2 + addl_var
+
+    if dist_var >= common_var + (args.state_sd / 100)**2:
+        return simulate.factor_sampler(race_predictions, common_var, dist_var,
+                groups=cd_vote.loc[races].state.values if args.state_sd > 0 else None,
+                group_var=(args.state_sd / 100)**2)
+    else: # not a one-factor structure; fall back to the full covariance matrix
+        if args.state_sd > 0:
+            print("Warning: district variance is below the shared and state variances, so "
+                  "races are simulated from the full covariance matrix without state errors "
+                  "(--state_sd is ignored).")
+        cov_matrix = np.full((len(race_predictions), len(race_predictions)), common_var)
+        np.fill_diagonal(cov_matrix, dist_var)
+        return simulate.dense_sampler(race_predictions, cov_matrix)
+
+# Sample the national model with NUTS, returning the fits, the draws of `pars`,
+# and convergence diagnostics. With --converge, chains are run
+# in batches (each continuing from the last) until the diagnostics meet their
+# targets, or the draws reach the number NAT_N would give.
+def run_nuts(model, mcmc_data, args, pars=("mu", "alpha_n")):
+    # split the post-warmup draws across chains, each with its own warmup
+    warmup = args.nat_n // 8
+    n_draws = math.ceil((args.nat_n - warmup) / args.chains)
+    sampling_args = {"warmup": warmup}
+
+    state_path = os.path.join(args.model_dir, "warm_start.pkl")
+    warm = args.warm_start and not args.backfill
+    if warm:
+        resumed = warm_start.resume_args(state_path, mcmc_data, args.chains,
+                                         min(args.warm_warmup, warmup))
+        if resumed is not None:
+            print("Resuming national model from previous run.")
+            sampling_args = resumed
+
+    n_jobs = -1 if args.n_jobs is None else args.n_jobs
+    batch = min(args.batch_n, n_draws) if args.converge else n_draws
+    fits = [model.sampling(data=mcmc_data, chains=args.chains, n_jobs=n_jobs,
+            iter=sampling_args["warmup"] + batch, **sampling_args)]
+    diag = convergence(fits, args)
+    while args.converge and not diag["converged"] and diag["draws"] < n_draws:
+        batch = min(args.batch_n, n_draws - diag["draws"])
+        fits.append(model.sampling(data=mcmc_data, chains=args.chains, n_jobs=n_jobs,
+                iter=batch, **warm_start.continue_args(fits[-1], args.chains)))
+        diag = convergence(fits, args)
+
+    if warm and not args.dry:
+        warm_start.save_state(state_path, fits[-1], mcmc_data)
+
+    samples = posterior.chain_draws(fits, pars) if pars else {}
+    samples = {k: v.reshape(-1, *v.shape[2:]) for k, v in samples.items()}
+    return fits, samples, diag
+
+# Diagnostics for election-day `mu`, `alpha_n` and the scale parameters, and
+# whether they meet the targets.
+def convergence(fits, args):
+    import diagnostics
+
+    draws = posterior.chain_draws(fits, ["mu", "alpha_n", "sigma_p", "sigma_e", "sigma_walk"])
+    draws["mu"] = draws["mu"][:, :, -1]
+    diag = diagnostics.summarize(draws)
+    diag["draws"] = draws["mu"].shape[1]
+    diag["batches"] = len(fits)
+    diag["converged"] = bool(diag["rhat"] <= args.rhat
+                             and min(diag["ess_bulk"], diag["ess_tail"]) >= args.min_ess)
+    return diag
+
+def print_summary(output_data):
+    margin = output_data["generic"].margin.iloc[-1]
+    prob = output_data["prob"]
+    gain = output_data["gain"]
+    se = output_data["sim_se"]
+
+    print(f"National Prediction: {'D' if margin >= 0 else 'R'}+{abs(margin):.1f}%")
+    print(f"Democrats have a {prob:.0%} chance of retaking the House.")
+    print(f"They are expected to {'gain' if gain > 0 else 'lose'} {abs(gain):.0f} seats.")
+    print(f"({output_data['sim_n']:,} simulations; standard error {se['prob']:.2%} on "
+          f"probability, {se['seats']:.2f} on seats.)")
+
+    diag = output_data.get("diagnostics")
+    if diag is not None:
+        print(f"National model: R-hat {diag['rhat']:.3f}, ESS {diag['ess_bulk']:.0f} bulk and "
+              f"{diag['ess_tail']:.0f} tail from {diag['draws']:,} draws per chain"
+              f"{'' if diag['converged'] else ' (below targets)'}; "
+              f"{diag['divergent']} divergent transitions.")
+
+    comparison = output_data.get("approx", {}).get("vs_nuts")
+    if comparison is not None:
+        print(f"Approximate national model ({output_data['approx']['method']}) differs from "
+              f"the last full run by {comparison['mu']['final_mean_diff']:+.2f} points on "
+              f"election day (KL {comparison['mu']['kl']:.3f}).")
+
+def log_history(entries, args):
+    if not os.path.isfile(args.history_log) and os.path.isfile(args.history_file):
+        history.import_json(args.history_file, args.history_log)
+
+    logged = []
+    for output_data in entries:
+        entry = {
+                "time": output_data["time"],
+                "prob": output_data["prob"],
+                "gain": output_data["gain"],
+            }
+        if "profile" in output_data:
+            entry["profile"] = output_data["profile"]
+        logged.append(entry)
+    history.append(logged, args.history_log)
+    print(f"Run logged to {args.history_log}.")
+
+    if args.compact_history:
+        history.compact(args.history_log, args.history_file)
+        print(f"History written to {args.history_file}.")
+
+
+#################################
+# Backfill historical dates     #
+#################################
+
+# Forecast every `args.step` days from `args.backfill[0]` to `args.backfill[1]`
+# across a pool of worker processes, which share the inputs loaded once by
+# the parent. History is written in one batch, in date order, and the output
+# file is updated with the latest date.
+def backfill(args, inputs):
+    start, end = args.backfill
+    dates = []
+    while start <= end:
+        dates.append(start)
+        start += timedelta(days=args.step)
+
+    # the stages of each forecast run in the workers, so the parent times the
+    # pool as a whole
+    timing.start("run forecasts")
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker,
+                             initargs=(inputs, args)) as pool:
+        results = list(pool.map(forecast_worker, dates))
+
+    timing.start("output")
+    for max_date, output_data in zip(dates, results):
+        print(f"{max_date:%Y-%m-%d}: {output_data['prob']:.0%} chance, "
+              f"{output_data['gain']:+.0f} seats")
     print()
 
+    if args.dry or not results:
+        return
 
+    write_output(results[-1], args)
 
-def get_polling_data(year=2018, max_date=None):
-    nov_1 = date(year, 11, 1)
-    election_day = nov_1 + timedelta(days=(1 - nov_1.weekday() + 7) % 7)
+    log_history(results, args)
+    save_results(results, args)
 
-    polls = pollster.questions_slug_poll_responses_clean_tsv_get(f"{str(year)[-2:]}-US-House")
-    polls = polls[polls.sample_subpopulation.isin(["Likely Voters", "Registered Voters"])]
-    polls.rename(columns={"observations": "n_resp"}, inplace=True)
+_worker_state = {}
 
-    if max_date is not None:
-        polls = polls[polls.end_date <= max_date]
+def init_worker(inputs, args):
+    # JOBS workers each running chains on every core would oversubscribe
+    if args.n_jobs is None:
+        args = argparse.Namespace(**{**vars(args), "n_jobs": 1})
+    _worker_state["inputs"] = inputs
+    _worker_state["args"] = args
+    # forked workers would otherwise share the parent's random state
+    np.random.seed()
 
-    polls["n_dem"] = polls.Democrat / (polls.Democrat + polls.Republican) * polls.n_resp
-    polls.dropna(subset=["n_dem"], inplace=True)
-    polls.n_dem = polls.n_dem.astype("int")
-    polls.n_resp = polls.n_resp.astype("int")
+# `overrides` replace command-line options for this forecast only.
+def forecast_worker(max_date, overrides=None):
+    args = _worker_state["args"]
+    if overrides:
+        args = argparse.Namespace(**{**vars(args), **overrides})
+    return forecast(max_date, _worker_state["inputs"], args)
 
-    polls["pollster"] = pd.factorize(polls.survey_house)[0] + 1
-    weeks = (election_day - polls.start_date).apply(lambda x: int(x.days / 7))
-    months = (election_day - polls.start_date).apply(lambda x: int(x.days / 30.4375))
-    n_weeks = weeks.max() + 1
-    n_months = months.max() + 1
-    polls["week"] = n_weeks - weeks
-    polls["month"] = n_months - months
 
-    polls.drop(["Democrat", "Republican", "Other", "Undecided", "survey_house", "start_date",
-                "end_date", "sample_subpopulation", "mode", "partisanship", "partisan_affiliation",
-                "poll_slug", "question_text", "margin_of_error"], axis=1, inplace=True)
+def fetch_polls(year=2018):
+    slug = f"{str(year)[-2:]}-US-House"
+    polls = cache.cached_call("pollster", slug,
+            lambda: get_pollster().questions_slug_poll_responses_clean_tsv_get(slug))
+    polls = polls[polls.sample_subpopulation.isin(["Likely Voters", "Registered Voters"])]
+    polls.rename(columns={"observations": "n_resp"}, inplace=True)
+
+    return polls
+
+# The local poll store, brought up to date with the latest fetch.
+def load_polls(year=2018):
+    slug = f"{str(year)[-2:]}-US-House"
+    store = pollstore.PollStore.load(election_day(year), pollstore.store_path(slug))
+    n_changed = store.update(fetch_polls(year))
+    if n_changed:
+        print(f"{n_changed} polls added, changed or dropped.")
+        store.save()
+    return store
+
+def get_polling_data(year=2018, max_date=None, raw=None):
+    if raw is None:
+        store = load_polls(year)
+    else:
+        store = pollstore.PollStore(election_day(year))
+        store.update(raw)
+    return store.select(max_date)
 
-    return polls, n_weeks, n_months
+def election_day(year):
+    nov_1 = date(year, 11, 1)
+    return nov_1 + timedelta(days=(1 - nov_1.weekday() + 7) % 7)
+
+def get_pollster():
+    import pollster
+    return pollster.Api()
 
 def find_not_running(year):
-    page = fetch(f"https://en.wikipedia.org/wiki/United_States_House_of_Representatives_elections,_{year}")
+    from bs4 import BeautifulSoup
+
+    page = cache.fetch_url(f"https://en.wikipedia.org/wiki/United_States_House_of_Representatives_elections,_{year}",
+                           "wikipedia")
     soup = BeautifulSoup(page, "lxml")
     # find the section that mentions retiring incumbents
     incumbents = soup.find("span", class_="mw-headline", string=re.compile("incumbent", re.I)).parent
@@ -290,9 +694,12 @@ def find_not_running(year):
     return not_running
 
 def get_incumbency():
+    from bs4 import BeautifulSoup
+
     data = []
     
-    page = fetch("https://en.wikipedia.org/wiki/Current_members_of_the_United_States_House_of_Representatives")
+    page = cache.fetch_url("https://en.wikipedia.org/wiki/Current_members_of_the_United_States_House_of_Representatives",
+                           "wikipedia")
     soup = BeautifulSoup(page, "lxml")
     
     heading = soup.find("span", id="Voting_members_by_state").parent
@@ -318,28 +725,129 @@ def get_incumbency():
     return pd.DataFrame(data).sort_values("district").set_index("district", drop=False)
 
 def name_to_abbr(name):
+    import us
     return us.states.lookup(name).abbr
 
 
 def get_args():
     parser = argparse.ArgumentParser(description="Forecast 2018 U.S. House races.",
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("command", nargs="?", default="forecast",
+            choices=["forecast", "output", "summary", "backtest"],
+            help="Run a forecast, rewrite the output file from stored results, "
+            "print the summary of stored results, or backtest past cycles.")
     parser.add_argument("--dry", action="store_true",
             help="Dry run, no results saved.")
-    parser.add_argument("--date", type=date_type, default=datetime.now(),
-            help="Date to model. Polls after this date are discarded.")
+    parser.add_argument("--date", type=date_type, default=None,
+            help="Date to model (default today). Polls after this date are discarded. "
+            "For output and summary, the run date to use (default latest).")
+    parser.add_argument("--backfill", type=date_type, nargs=2, metavar=("START", "END"),
+            help="Model every STEP days from START to END, logging each run to history.")
+    parser.add_argument("--step", type=int, nargs="?", default=1,
+            help="Days between dates when backfilling.")
+    parser.add_argument("--jobs", type=int, nargs="?", default=os.cpu_count(),
+            help="Worker processes to use when backfilling, sweeping, backtesting or serving.")
+    parser.add_argument("--cycles", type=int, nargs="+",
+            default=[2002, 2004, 2006, 2008, 2010, 2012, 2014],
+            help="Past cycles to backtest.")
+    parser.add_argument("--days_before", type=int, nargs="+", default=[7, 14],
+            help="Backtest each cycle as of these numbers of days before election day.")
+    parser.add_argument("--backtest_file", type=str, nargs="?", default="backtest.json",
+            help="Where to write the backtest report.")
+    parser.add_argument("--sweep", type=str, nargs="?", default=None, metavar="GRID",
+            help="Rerun the forecast for DATE under each prior setting in this JSON "
+            "file, reweighting the national draws where possible (see sensitivity.py).")
+    parser.add_argument("--sweep_file", type=str, nargs="?", default="sensitivity.csv",
+            help="File in which to write the table of sweep results.")
+    parser.add_argument("--serve", action="store_true",
+            help="Keep models and data loaded and serve forecasts over HTTP (see server.py).")
+    parser.add_argument("--port", type=int, nargs="?", default=8018,
+            help="Port on which to serve forecasts.")
+    parser.add_argument("--socket", type=str, nargs="?", default=None,
+            help="Serve forecasts on this Unix socket instead of a port.")
     parser.add_argument("--race_n", type=int, nargs="?", default=20_000,
             help="MCMC iterations for individual races.")
+    parser.add_argument("--chunk_size", type=int, nargs="?", default=5000,
+            help="Race simulations to draw at a time.")
+    parser.add_argument("--sim_method", type=str, nargs="?", default="mc",
+            choices=simulate.METHODS,
+            help="Draws for race simulations: independent (mc), antithetic pairs, or "
+            "scrambled Sobol points (see simulate.py).")
+    parser.add_argument("--control_variates", action="store_true",
+            help="Adjust race simulation estimates with control variates.")
+    parser.add_argument("--state_sd", type=float, nargs="?", default=0.0,
+            help="Standard deviation (in points) of race errors shared within a state.")
+    parser.add_argument("--target_se", type=float, nargs="?", default=None,
+            help="Stop race simulations early once the standard error of the "
+            "majority probability falls below this (and of the median seat count "
+            "below 0.5). At most RACE_N simulations are run.")
     parser.add_argument("--nat_n", type=int, nargs="?", default=3000,
             help="MCMC iterations for national poll aggregation.")
+    parser.add_argument("--chains", type=int, nargs="?", default=4,
+            help="MCMC chains for national poll aggregation. NAT_N iterations are "
+            "split among them.")
+    parser.add_argument("--n_jobs", type=int, nargs="?", default=None,
+            help="Cores on which to run chains (-1 for all). By default all, or 1 in "
+            "each worker process when backfilling, sweeping, backtesting or serving.")
+    parser.add_argument("--converge", action="store_true",
+            help="Sample the national model in batches until R-hat and bulk and tail "
+            "ESS meet their targets, drawing no more than NAT_N would.")
+    parser.add_argument("--batch_n", type=int, nargs="?", default=250,
+            help="Draws per chain in each batch with --converge.")
+    parser.add_argument("--rhat", type=float, nargs="?", default=1.01,
+            help="Largest acceptable R-hat with --converge.")
+    parser.add_argument("--min_ess", type=float, nargs="?", default=400,
+            help="Smallest acceptable bulk and tail ESS with --converge.")
+    parser.add_argument("--warm_start", action="store_true",
+            help="Start the national model from the last run's posterior and "
+            "adaptation, with a short warmup, if only new polls have been added.")
+    parser.add_argument("--warm_warmup", type=int, nargs="?", default=100,
+            help="Warmup iterations when warm starting.")
+    parser.add_argument("--approx", type=str, nargs="?", const="meanfield", default=None,
+            choices=approx.METHODS,
+            help="Approximate the national model with variational inference "
+            "(meanfield or fullrank) or a Laplace approximation instead of sampling.")
+    parser.add_argument("--approx_n", type=int, nargs="?", default=2000,
+            help="Draws from the approximate national posterior.")
     parser.add_argument("--recompile", action="store_true",
-            help="Force recompile of STAN model.")
+            help="Force recompile of STAN model. (It is recompiled automatically "
+            "when house.stan or PyStan changes.)")
     parser.add_argument("--model_dir", type=str, nargs="?", default="models",
             help="Directory in which models are stored.")
+    parser.add_argument("--offline", action="store_true",
+            help="Never fetch from the network; use cached or fixture responses only.")
+    parser.add_argument("--cache_dir", type=str, nargs="?", default="cache",
+            help="Directory in which fetched data is cached.")
+    parser.add_argument("--fixture_dir", type=str, nargs="?", default=None,
+            help="Directory of saved responses (laid out like the cache) to use offline.")
+    parser.add_argument("--profile", type=str, nargs="?", const="profile.json", default=None,
+            help="Record time and memory used by each stage, and sampler statistics, "
+            "to this file.")
+    parser.add_argument("--profile_history", action="store_true",
+            help="With --profile, also log stage times with the run history.")
+    parser.add_argument("--save_draws", action="store_true",
+            help="Store posterior draws and race simulations for later analysis.")
+    parser.add_argument("--save_scenarios", action="store_true",
+            help="Store district winners of each race simulation for ./scenarios.py.")
+    parser.add_argument("--draws_dir", type=str, nargs="?", default="draws",
+            help="Directory in which draws are stored, one subdirectory per run date.")
     parser.add_argument("--output_file", type=str, nargs="?", default="docs/data/output.json",
             help="File in which to output results.")
+    parser.add_argument("--output_format", type=str, nargs="?", default="records",
+            choices=["records", "columnar"],
+            help="Write district and national tables as lists of records or as columns.")
+    parser.add_argument("--precision", type=int, nargs="?", default=4,
+            help="Decimal places kept for probabilities in columnar output.")
+    parser.add_argument("--no_compress", action="store_true",
+            help="Don't write gzip and brotli copies of the output file.")
+    parser.add_argument("--results_dir", type=str, nargs="?", default="results",
+            help="Directory in which the full results of each run are stored.")
     parser.add_argument("--history_file", type=str, nargs="?", default="docs/data/history.json",
-            help="File in which to store model history.")
+            help="JSON file of model history read by the site.")
+    parser.add_argument("--history_log", type=str, nargs="?", default="docs/data/history.log",
+            help="Append-only log in which model history is stored.")
+    parser.add_argument("--compact_history", action="store_true",
+            help="Rewrite HISTORY_FILE from the history log after logging.")
 
     return parser.parse_args()
 
@@ -0,0 +1,62 @@
+# OUTPUT FILES FOR THE SITE
+#
+# District and national tables can be written either as a list of records (one
+# object per row) or as columns (one array per field), with values rounded to
+# a fixed number of digits. Gzip and, if the brotli package is installed,
+# brotli-compressed copies are written alongside for servers that can serve
+# precompressed files.
+
+import gzip
+import json
+import math
+
+import numpy as np
+
+# fields holding probabilities; everything else is in percentage points
+PROB_FIELDS = {"prob", "seats_dist", "dem_gain", "gop_gain"}
+
+
+# `output_data` as written to the output file. Its "districts" and "generic"
+# entries are data frames. Unknown (infinite) standard errors are written as
+# null, since JSON has no infinity.
+def format_output(output_data, fmt="records", digits=4):
+    data = dict(output_data)
+    if "sim_se" in data:
+        data["sim_se"] = {k: v if math.isfinite(v) else None for k, v in data["sim_se"].items()}
+    if fmt == "records":
+        data["districts"] = output_data["districts"].to_dict("records")
+        data["generic"] = output_data["generic"].to_dict("records")
+        return data
+
+    data["format"] = "columnar"
+    for key in ["districts", "generic"]:
+        data[key] = {col: quantize(col, values, digits)
+                     for col, values in output_data[key].items()}
+    for key in ["prob", "seats_dist"]:
+        data[key] = quantize(key, data[key], digits)
+    data["scenarios"] = {k: quantize(k, v, digits) for k, v in data["scenarios"].items()}
+
+    return data
+
+def write_output(data, path, compress=True):
+    raw = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(raw)
+
+    if not compress:
+        return
+    with open(path + ".gz", "wb") as f:
+        f.write(gzip.compress(raw, compresslevel=9, mtime=0))
+    try:
+        import brotli
+    except ImportError:
+        return
+    with open(path + ".br", "wb") as f:
+        f.write(brotli.compress(raw))
+
+
+def quantize(field, values, digits):
+    values = np.asarray(values)
+    if values.dtype.kind != "f":
+        return values.tolist()
+    return np.round(values, digits if field in PROB_FIELDS else 2).tolist()
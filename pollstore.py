@@ -0,0 +1,153 @@
+# LOCAL POLL STORE
+#
+# Keeps every poll we have seen, keyed by poll id, with the columns the
+# national model needs already computed: sample sizes, Democratic responses,
+# a pollster id, and the weeks and months between the poll and election day.
+# Each fetch is compared with the store by a hash of each poll's row, and only
+# new or changed polls are processed. Pollster ids are assigned once, in the
+# order pollsters first appear, so they stay the same from run to run (which
+# warm starts rely on), and new polls are added after the old ones.
+#
+# Building the Stan arrays for a date is then a filter and a subtraction.
+
+import os
+import pickle
+
+import pandas as pd
+
+import cache
+
+# columns of a fetched poll that the model uses
+FIELDS = ["poll_slug", "sample_subpopulation", "survey_house", "start_date", "end_date",
+          "Democrat", "Republican", "n_resp"]
+
+
+class PollStore:
+    def __init__(self, election_day, path=None):
+        self.election_day = pd.Timestamp(election_day)
+        self.path = path
+        self.polls = pd.DataFrame({
+            "hash": pd.Series(dtype="uint64"),
+            "end_date": pd.Series(dtype="datetime64[ns]"),
+            "weeks_before": pd.Series(dtype="int64"),
+            "months_before": pd.Series(dtype="int64"),
+            "n_resp": pd.Series(dtype="int64"),
+            "n_dem": pd.Series(dtype="int64"),
+            "pollster": pd.Series(dtype="int64"),
+        })
+        self.pollsters = {}
+        # hashes of polls `prepare` drops (no usable vote shares), so they
+        # aren't counted as changed on every update
+        self.skipped = {}
+
+    # The store saved at `path`, or an empty one.
+    @classmethod
+    def load(cls, election_day, path):
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                store = pickle.load(f)
+            if store.election_day == pd.Timestamp(election_day):
+                store.path = path
+                store.skipped = getattr(store, "skipped", {})
+                return store
+        return cls(election_day, path)
+
+    def save(self):
+        if self.path is not None:
+            cache.write(self.path, pickle.dumps(self))
+
+    # Bring the store up to date with `raw` (as returned by `house.fetch_polls`)
+    # and return the number of polls added, changed or dropped (polls missing
+    # from `raw` are dropped).
+    def update(self, raw):
+        raw = raw[FIELDS]
+        keys = (raw.poll_slug.astype(str) + "/" + raw.sample_subpopulation.astype(str)).values
+        hashes = pd.Series(pd.util.hash_pandas_object(raw, index=False).values, index=keys)
+        hashes = hashes[~hashes.index.duplicated(keep="last")]
+
+        known = pd.concat([self.polls.hash, pd.Series(self.skipped, dtype="uint64")])
+        changed = hashes[hashes != known.reindex(hashes.index)]
+        removed = known.index.difference(hashes.index)
+        if len(changed) == 0 and len(removed) == 0:
+            return 0
+
+        rows = raw.set_axis(keys)
+        rows = rows[rows.index.isin(changed.index) & ~rows.index.duplicated(keep="last")]
+        new = self.prepare(rows)
+        new["hash"] = changed[new.index]
+        new = new[self.polls.columns]
+
+        self.skipped = {k: h for k, h in self.skipped.items()
+                        if k in hashes.index and k not in changed.index}
+        self.skipped.update({k: changed[k] for k in changed.index.difference(new.index)})
+
+        # changed polls keep their place; new ones go at the end
+        polls = self.polls.drop(removed.union(changed.index.difference(new.index)),
+                                errors="ignore")
+        old = new.index.isin(polls.index)
+        polls.loc[new.index[old]] = new[old]
+        self.polls = pd.concat([polls, new[~old]])
+        return len(changed) + len(removed)
+
+    def prepare(self, rows):
+        rows = rows.assign(n_dem=rows.Democrat / (rows.Democrat + rows.Republican) * rows.n_resp)
+        rows = rows.dropna(subset=["n_dem"])
+
+        start_date = pd.to_datetime(rows.start_date)
+        end_date = pd.to_datetime(rows.end_date)
+        days = (self.election_day - start_date).dt.days
+
+        # new pollsters get the next ids, in order of their first poll
+        for name in rows.survey_house[end_date.sort_values(kind="stable").index].unique():
+            if name not in self.pollsters:
+                self.pollsters[name] = len(self.pollsters) + 1
+
+        return pd.DataFrame({
+            "end_date": end_date,
+            "weeks_before": (days / 7).astype("int64"),
+            "months_before": (days / 30.4375).astype("int64"),
+            "n_resp": rows.n_resp.astype("int64"),
+            "n_dem": rows.n_dem.astype("int64"),
+            "pollster": rows.survey_house.map(self.pollsters).astype("int64"),
+        }, index=rows.index)
+
+    # Polls ending on or before `max_date`, with weeks and months counted from
+    # the earliest of them (as in the Stan data), and the numbers of weeks and
+    # months.
+    def select(self, max_date=None):
+        polls = self.polls
+        if max_date is not None:
+            polls = polls[polls.end_date <= max_date]
+        if len(polls) == 0:
+            raise ValueError("No polls in the store." if max_date is None else
+                             f"No polls end on or before {pd.Timestamp(max_date):%Y-%m-%d}.")
+
+        n_weeks = polls.weeks_before.max() + 1
+        n_months = polls.months_before.max() + 1
+        polls = pd.DataFrame({
+            "n_resp": polls.n_resp.values,
+            "n_dem": polls.n_dem.values,
+            "pollster": polls.pollster.values,
+            "week": n_weeks - polls.weeks_before.values,
+            "month": n_months - polls.months_before.values,
+        }, index=polls.index)
+        return polls, int(n_weeks), int(n_months)
+
+    # Stan input arrays for the polls ending on or before `max_date`.
+    def arrays(self, max_date=None):
+        polls, n_weeks, n_months = self.select(max_date)
+        return {
+            "W": n_weeks,
+            "M": n_months,
+            "N": len(polls),
+            "P": int(polls.pollster.max()),
+            "w": polls.week.values,
+            "m": polls.month.values,
+            "n_resp": polls.n_resp.values,
+            "n_dem": polls.n_dem.values,
+            "p": polls.pollster.values,
+        }
+
+
+def store_path(slug):
+    return os.path.join(cache.settings["cache_dir"], "polls", f"{slug}.pkl")
@@ -0,0 +1,89 @@
+# STREAMING POSTERIOR SUMMARIES
+#
+# Means, standard deviations and quantiles of chosen parameters, read straight
+# from the sampler's own per-element draw arrays (`fit.sim["samples"]`)
+# instead of through `fit.extract`, which copies the draws of every parameter
+# (including the per-poll `u` and `logit_dem`) into new arrays. Moments are
+# accumulated a chunk of iterations at a time, merging running means and sums
+# of squares across chunks, chains and batches, so memory use doesn't grow
+# with the number of polls or draws. Quantiles need the sorted draws of one
+# element at a time.
+
+import numpy as np
+
+
+# Names of the scalar elements of `par` in `fit` (e.g. "mu[1]"), in column-major
+# order, and its dimensions.
+def element_names(fit, par):
+    dims = fit.par_dims[fit.model_pars.index(par)]
+    names = [name for name in fit.sim["fnames_oi"] if name == par or name.startswith(par + "[")]
+    return names, list(dims)
+
+# Views of each chain's post-warmup draws of element `name` of `fit`.
+def chain_views(fit, name):
+    return [holder.chains[name][warmup:]
+            for holder, warmup in zip(fit.sim["samples"], fit.sim["warmup2"])]
+
+# Post-warmup draws of each of `pars`, across all `fits` (successive batches
+# of the same chains), shaped (chains, iterations, *dims).
+def chain_draws(fits, pars):
+    draws = {}
+    for par in pars:
+        names, dims = element_names(fits[0], par)
+        flat = np.stack([np.stack([np.concatenate(batches) for batches in
+                                   zip(*[chain_views(fit, name) for fit in fits])])
+                         for name in names], axis=-1)
+        draws[par] = flat.reshape(*flat.shape[:2], *dims, order="F")
+    return draws
+
+# Mean, standard deviation and `quantiles` of each of `pars` over the draws of
+# all chains of all `fits`, each shaped like the parameter.
+def summarize(fits, pars, quantiles=(), chunk_size=1000):
+    summary = {}
+    for par in pars:
+        names, dims = element_names(fits[0], par)
+
+        n, mean, m2 = 0, np.zeros(len(names)), np.zeros(len(names))
+        for fit in fits:
+            views = [chain_views(fit, name) for name in names]
+            for chain in zip(*views):
+                for start in range(0, len(chain[0]), chunk_size):
+                    block = np.column_stack([x[start:start + chunk_size] for x in chain])
+                    n, mean, m2 = merge_moments(n, mean, m2, block)
+
+        summary[par] = {
+            "mean": shape(mean, dims),
+            "std": shape(np.sqrt(m2 / n), dims),
+        }
+        if quantiles:
+            q = np.empty((len(quantiles), len(names)))
+            for j, name in enumerate(names):
+                q[:, j] = np.quantile(np.concatenate(
+                        [x for fit in fits for x in chain_views(fit, name)]), quantiles)
+            summary[par]["quantiles"] = {p: shape(row, dims) for p, row in zip(quantiles, q)}
+    return summary
+
+# The same summary of draws already in memory, shaped (draws, *dims).
+def summarize_draws(samples, quantiles=()):
+    summary = {}
+    for par, values in samples.items():
+        summary[par] = {"mean": values.mean(axis=0), "std": values.std(axis=0)}
+        if quantiles:
+            q = np.quantile(values, quantiles, axis=0)
+            summary[par]["quantiles"] = dict(zip(quantiles, q))
+    return summary
+
+# Count, means and sums of squared deviations after adding the rows of
+# `block` (Chan et al.'s pairwise update).
+def merge_moments(n, mean, m2, block):
+    k = len(block)
+    block_mean = block.mean(axis=0)
+    block_m2 = ((block - block_mean)**2).sum(axis=0)
+    delta = block_mean - mean
+    total = n + k
+    return (total, mean + delta * k / total, m2 + block_m2 + delta**2 * n * k / total)
+
+# Column-major reshape to the parameter's dimensions; scalars become numpy
+# scalars.
+def shape(values, dims):
+    return values.reshape(dims, order="F")[()]
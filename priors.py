@@ -2,9 +2,6 @@
 
 import os
 import re
-from datetime import date
-
-from urllib.request import urlopen as fetch
 
 import pandas as pd
 import numpy as np
@@ -14,13 +11,29 @@ from statsmodels.regression.linear_model import OLSResults
 
 import us
 
+import artifacts
+import cache
+import datafiles
+
 
 def get_national_prior(recalculate=False, filename="nat_prior.pkl", model_dir="models"):
     path = os.path.join(model_dir, filename)
+    key = artifacts.artifact_key(files=["data/approval.csv"],
+            code=[get_national_prior, national_prior_data, fit_national_prior, get_gdp_data,
+                  get_approvals_data, prepare_approvals],
+            libraries=["pandas", "numpy", "statsmodels"])
 
-    if os.path.isfile(path) and not recalculate:
+    if artifacts.is_current(path, key) and not recalculate:
         return OLSResults.load(path)
 
+    nat_prior = fit_national_prior(national_prior_data())
+    nat_prior.save(path)
+    artifacts.record(path, key)
+
+    return nat_prior
+
+# Fundamentals and House popular vote margin for each cycle, indexed by year.
+def national_prior_data():
     years = range(1992, 2016, 2)
 
     gdp_growth = get_gdp_data()
@@ -36,30 +49,39 @@ def get_national_prior(recalculate=False, filename="nat_prior.pkl", model_dir="m
 
     for year in years:
         gdp_series.append(gdp_growth.loc[f"{year - 1}-01-01"])
-        approval = approvals[(date(year, 1, 1) < approvals.date)
-                             & (approvals.date < date(year, 6, 1))].approval.mean()
+        approval = approvals[(pd.Timestamp(year, 1, 1) < approvals.date)
+                             & (approvals.date < pd.Timestamp(year, 6, 1))].approval.mean()
         approval_series.append(approval)
         midterm_series.append(0 if year % 4 == 0 else 1)
         
 
-    ndata = pd.DataFrame({"GDP": gdp_series, "APPR": approval_series,
-                        "INC": incumbency_series, "MRG": nat_margin_series,
-                        "PRES": president_series, "MID": midterm_series, 
+    return pd.DataFrame({"GDP": gdp_series, "APPR": approval_series,
+                         "INC": incumbency_series, "MRG": nat_margin_series,
+                         "PRES": president_series, "MID": midterm_series, 
                          "YR": range(-len(years), 0)}, index=years)
 
-    nat_prior = smf.ols("MRG ~ APPR + INC:PRES + PRES:MID", data=ndata).fit()
-    nat_prior.save(path)
-
-    return nat_prior
+def fit_national_prior(data):
+    return smf.ols("MRG ~ APPR + INC:PRES + PRES:MID", data=data).fit()
 
 def get_race_prior(recalculate=False, filename="race_prior.pkl", model_dir="models"):
     path = os.path.join(model_dir, filename)
+    key = artifacts.artifact_key(files=["data/cd_president.tsv", "data/generic_polling.tsv"],
+            code=[get_race_prior, fit_race_prior, prepare_race_data, summarize_races,
+                  get_results, get_pvi_data, add_pvi, get_error_by_year, get_generic_polling],
+            libraries=["pandas", "numpy", "statsmodels"])
 
-    if os.path.isfile(path) and not recalculate:
+    if artifacts.is_current(path, key) and not recalculate:
         return OLSResults.load(path)
 
-    data = prepare_race_data()
+    race_prior = fit_race_prior(prepare_race_data())
+    race_prior.save(path)
+    artifacts.record(path, key)
+
+    return race_prior
 
+# `data` is a frame like that from `prepare_race_data`.
+def fit_race_prior(data):
+    data = data.copy()
     race_prior = smf.ols("MRG ~ INC + PVI + ADJ + NAT + PRES*MID", data=data).fit()
 
     # Calculate covariance matrix of race prior model
@@ -72,27 +94,17 @@ def get_race_prior(recalculate=False, filename="race_prior.pkl", model_dir="mode
     race_prior.dist_var = cov_matrix.diagonal().mean()
     race_prior.dist_cov = np.extract(1 - np.identity(cov_matrix.shape[0]), cov_matrix).mean()
 
-    race_prior.save(path)
-
     return race_prior
 
-def prepare_race_data():
+# `results` may map years to frames like those from `get_results`, and `cd_vote`
+# may be a frame like that from `get_pvi_data`; otherwise they are loaded.
+def prepare_race_data(results=None, cd_vote=None):
     years = range(2002, 2016, 2)
 
-    gdp_growth = get_gdp_data()
-    approvals = get_approvals_data()
-    cd_vote = get_pvi_data()
+    if cd_vote is None:
+        cd_vote = get_pvi_data()
     error_by_year = get_error_by_year()
 
-    incumbency_series = []
-    margin_series = []
-    pvi_series = []
-    pres_margin_series = []
-    nat_series = []
-    district_series = []
-    president_series = []
-    midterm_series = []
-    years_series = []
     # party of sitting president in each year (1 for Democrat)
     president = {
         2000: 1,
@@ -105,78 +117,88 @@ def prepare_race_data():
         2014: 1,
     }
 
+    frames = []
     for year in years:
-        results = get_results(year)
-        
         if year % 4 == 0: # presidential election year
             pvi_string = f"pvi_{year - 2}"
             pres_string = f"pres_margin_{str(year - 4)[-2:]}"
         else:
             pvi_string = f"pvi_{year}"
             pres_string = f"pres_margin_{str(year - 2)[-2:]}"
-        
-        for race, row in results.groupby("race"):
-            dem = row[(row.party == "D") | (row.party == "DFL") | (row.party == "D*")
-                     | (row.party == "DEM") | row.party.str.contains("D/") | row.party.str.contains("DEM/")]
-            gop = row[(row.party == "R") | (row.party == "R*")| (row.party == "REP")
-                     | row.party.str.contains("R/") | row.party.str.contains("REP/")]
-            
-            # uncontested seat
-            if len(dem) == 0:
-                incumbent = -1 if gop.iloc[0].incumbent else 0
-                margin = np.nan
-            elif len(gop) == 0: 
-                incumbent = 1 if dem.iloc[0].incumbent else 0
-                margin = np.nan
-            else:
-                margin = dem.general_pct.sum() - gop.general_pct.sum()
-                incumbent = 1 if dem.iloc[0].incumbent else -1 if gop.iloc[0].incumbent else 0
-            
-            
-            margin_series.append(margin)
-            incumbency_series.append(incumbent)
-            pvi_series.append(cd_vote.loc[cd_vote.race == race, pvi_string].item())
-            pres_margin_series.append(cd_vote.loc[cd_vote.race == race, pres_string].item())
-            district_series.append(race)
-            president_series.append(president[year])
-            midterm_series.append(0 if year % 4 == 0 else 1)
-            years_series.append(year)
-            
-            idx = (year - 2016) // 2
-            nat_series.append(error_by_year[year])
-
-    data = pd.DataFrame({"INC": incumbency_series, "MRG": margin_series,
-                        "PVI": pvi_series, "DIST": district_series,
-                        "PRES": president_series, "MID": midterm_series,
-                        "NAT": nat_series, "WIN": np.sign(margin_series),
-                        "YR": (np.array(years_series) - 2016)/2, 
-                        "ADJ": pres_margin_series}, index=years_series)
+
+        races = summarize_races(get_results(year) if results is None else results[year])
+        races = races.join(cd_vote[[pvi_string, pres_string]])
+
+        frames.append(pd.DataFrame({
+            "INC": races.incumbent.values,
+            "MRG": races.margin.values,
+            "PVI": races[pvi_string].values,
+            "DIST": races.index.values,
+            "PRES": president[year],
+            "MID": 0 if year % 4 == 0 else 1,
+            "NAT": error_by_year[year],
+            "WIN": np.sign(races.margin.values),
+            "YR": (year - 2016) / 2,
+            "ADJ": races[pres_string].values,
+        }, index=np.full(len(races), year)))
+
+    data = pd.concat(frames)
     data_clean = data.dropna()
 
     return data_clean
 
+# Democratic and Republican vote share and incumbency for each race. Uncontested
+# races have a missing margin.
+def summarize_races(results):
+    party = results.party
+    dem = (party.isin(["D", "DFL", "D*", "DEM"])
+           | party.str.contains("D/", regex=False) | party.str.contains("DEM/", regex=False))
+    gop = (party.isin(["R", "R*", "REP"])
+           | party.str.contains("R/", regex=False) | party.str.contains("REP/", regex=False))
+
+    # a candidate running on both lines counts for both parties
+    candidates = pd.concat([results[dem].assign(side="dem"), results[gop].assign(side="gop")])
+    by_side = (candidates.groupby(["race", "side"], sort=False)
+               .agg(pct=("general_pct", "sum"), incumbent=("incumbent", "first"))
+               .unstack("side")
+               .reindex(columns=pd.MultiIndex.from_product([["pct", "incumbent"], ["dem", "gop"]]))
+               .sort_index())
+
+    dem_inc = by_side["incumbent", "dem"].fillna(False).astype(bool)
+    gop_inc = by_side["incumbent", "gop"].fillna(False).astype(bool)
+
+    return pd.DataFrame({
+        "margin": by_side["pct", "dem"] - by_side["pct", "gop"],
+        "incumbent": np.where(dem_inc, 1, np.where(gop_inc, -1, 0)),
+    }, index=by_side.index)
+
 
 # Generic Congressional Ballot Polling
 def get_bias_prior(recalculate=False, filename="bias_prior.pkl", model_dir="models"):
     path = os.path.join(model_dir, filename)
+    key = artifacts.artifact_key(files=["data/generic_polling.tsv"],
+            code=[get_bias_prior, fit_bias_prior, get_generic_polling],
+            libraries=["pandas", "numpy", "statsmodels"])
 
-    if os.path.isfile(path) and not recalculate:
+    if artifacts.is_current(path, key) and not recalculate:
         return OLSResults.load(path)
 
-    generic = pd.read_table("data/generic_polling.tsv")
-    bias_by_month = generic.groupby("months").error.mean().values
+    bias_model = fit_bias_prior(get_generic_polling())
+    bias_model.save(path)
+    artifacts.record(path, key)
+
+    return bias_model
 
-    avg_final_bias = (generic.error / 100).mean()
-    final_bias_std = (generic.error / 100).std()
+def fit_bias_prior(generic):
+    bias_by_month = generic.groupby("months").error.mean().values
 
     bias_model = smf.ols("error ~ months", data=generic).fit()
     bias_model.step_var = ((bias_by_month[1:] - bias_by_month[:-1])**2).mean() / 100**2
-    bias_model.save(path)
 
     return bias_model
 
 def get_error_by_year():
-    generic = pd.read_table("data/generic_polling.tsv")
+    generic = get_generic_polling()
 
     # how polling avg in final month compared to end result
     error_by_year = generic[generic.months == 0].groupby("year").error.mean().to_dict()
@@ -187,15 +209,27 @@ def get_error_by_year():
     return error_by_year
 
 
+def get_generic_polling():
+    return datafiles.load("data/generic_polling.tsv",
+            {"months": "int64", "error": "float64", "year": "int64"})
+
+
 # YEARLY GDP GROWTH
 def get_gdp_data():
-    from fredapi import Fred
-    FRED = Fred("75d3a2383e8806d7b956a4849aff66a9")
-    return FRED.get_series('A191RL1A225NBEA', observation_start='1940-01-01')
+    def get_series():
+        from fredapi import Fred
+        FRED = Fred("75d3a2383e8806d7b956a4849aff66a9")
+        return FRED.get_series('A191RL1A225NBEA', observation_start='1940-01-01')
+
+    return cache.cached_call("fred", "A191RL1A225NBEA/1940-01-01", get_series)
 
 # PRESIDENTIAL APPROVAL RATINGS
 def get_approvals_data():
-    approvals = pd.read_table("data/approval.csv")
+    return datafiles.load("data/approval.csv",
+            {"Approving": "float64", "President": "str", "Week Ending Date": "str"},
+            prepare=prepare_approvals)
+
+def prepare_approvals(approvals):
     approvals = approvals[["Approving", "President", "Week Ending Date"]]
     approvals.rename(columns={
         "Approving": "approval", 
@@ -203,16 +237,25 @@ def get_approvals_data():
         "Week Ending Date": "date"}, 
                      inplace=True)
 
-    approvals.date = pd.to_datetime(approvals.date)
+    approvals.date = pd.to_datetime(approvals.date, format="%m/%d/%y")
 
-    approvals.loc[approvals.date >= pd.to_datetime("1/1/2020"), "date"] -= np.timedelta64(100, "Y")
+    # two-digit years before 1969 are read as 20xx
+    early = approvals.date >= pd.to_datetime("1/1/2020")
+    approvals.loc[early, "date"] -= pd.DateOffset(years=100)
     approvals.sort_values("date", inplace=True)
 
     return approvals
 
 # Cook PVI
-def get_pvi_data():
-    cd_vote = pd.read_table("data/cd_president.tsv")
+def get_pvi_data(filename="data/cd_president.tsv"):
+    columns = {"state": "str", "district": "int64", "race": "str"}
+    for year in ["00", "04", "08", "12", "16"]:
+        columns[f"dem_{year}"] = "float64"
+        columns[f"gop_{year}"] = "float64"
+
+    return datafiles.load(filename, columns, prepare=add_pvi)
+
+def add_pvi(cd_vote):
     # national presidential popular vote margin
     national_margin = {
         2000: 0.5,
@@ -247,7 +290,7 @@ def get_pvi_data():
 # Get House results for a particular year, 2000-2014
 def get_results(year):
     url = f"http://openelections.github.io/fec_results/api/{year}/congress/results.json"
-    raw = fetch(url).read().decode("utf-8")
+    raw = cache.fetch_url(url, "openelections").decode("utf-8")
 
     formatted = re.sub(r'\\\\\\"', "'", raw)
     formatted = re.sub(r'(?<!\\)"', "", formatted)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# CONDITIONAL SCENARIOS OVER STORED SIMULATIONS
+#
+# For each run we keep which party won each district in each simulation, as
+# bitsets with one bit per simulation (one row of packed bytes per district),
+# along with the seat count and national environment of each simulation.
+# Conditions on districts are then bitwise ANDs of rows, and probabilities are
+# popcounts, so queries over a million simulations take milliseconds.
+#
+#   ./scenarios.py --date 2018-07-15 --dem PA-07 NJ-11
+#   ./scenarios.py --date 2018-07-15 --national 0 4
+
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+import draws
+
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+# Collects simulations a chunk at a time for `save`. The national environment
+# of a simulation is `national` (the modeled national margin) plus the
+# average deviation of its districts from `predictions`.
+class ScenarioRecorder:
+    def __init__(self, predictions, national):
+        self.predictions = np.asarray(predictions)
+        self.national = national
+        self.packed = []
+        self.seats = []
+        self.environment = []
+        self.leftover = None
+
+    def add(self, chunk):
+        won = chunk > 0
+        self.seats.append(won.sum(axis=1).astype(np.uint16))
+        self.environment.append(self.national
+                                + 100 * (chunk - self.predictions).mean(axis=1))
+
+        # pack whole bytes only, carrying the remainder to the next chunk
+        if self.leftover is not None:
+            won = np.concatenate([self.leftover, won])
+        full = len(won) // 8 * 8
+        self.packed.append(np.packbits(won[:full], axis=0))
+        self.leftover = won[full:]
+
+    def save(self, writer):
+        packed = self.packed + [np.packbits(self.leftover, axis=0)]
+        writer.save("winners", np.concatenate(packed).T, dtype="uint8")
+        writer.save("seats", np.concatenate(self.seats), dtype="uint16")
+        writer.save("national", np.concatenate(self.environment), dtype="float32")
+
+
+class Scenarios:
+    def __init__(self, path, majority=218):
+        arrays = draws.open_run(path, names=["winners", "seats", "national"])
+        self.winners = arrays["winners"]
+        self.seats = arrays["seats"]
+        self.national = arrays["national"]
+        self.n = len(self.seats)
+        self.majority = majority
+
+        districts = draws.load_manifest(path)["labels"]["districts"]
+        self.district_index = {d: i for i, d in enumerate(districts)}
+        self.all = np.packbits(np.ones(self.n, dtype=bool))
+
+    # Bitset of simulations in which Democrats win every district in `dem`,
+    # Republicans win every district in `gop`, and the national environment
+    # is within `national` (a (low, high) pair, in points).
+    def condition(self, dem=(), gop=(), national=None):
+        mask = self.all.copy()
+        for district in dem:
+            mask &= self.winners[self.district_index[district]]
+        for district in gop:
+            mask &= ~self.winners[self.district_index[district]]
+        if national is not None:
+            low, high = national
+            mask &= np.packbits((self.national >= low) & (self.national <= high))
+        return mask
+
+    def query(self, dem=(), gop=(), national=None):
+        mask = self.condition(dem, gop, national)
+        n = count(mask)
+        if n == 0:
+            return {"n": 0, "share": 0.0}
+
+        majority = mask & np.packbits(np.asarray(self.seats) >= self.majority)
+        seats = np.asarray(self.seats)[np.unpackbits(mask, count=self.n).astype(bool)]
+        seats_dist = np.bincount(seats, minlength=len(self.winners) + 1) / n
+        cdf = np.cumsum(seats_dist)
+
+        return {
+            "n": n,
+            "share": n / self.n,
+            "prob": count(majority) / n,
+            "seats": int(np.searchsorted(cdf, 0.5 - 1e-12)),
+            "seats_min": int(np.searchsorted(cdf, 0.1 - 1e-12)),
+            "seats_max": int(np.searchsorted(cdf, 0.9 - 1e-12)),
+            "seats_dist": seats_dist,
+        }
+
+    # Probability that Democrats win each district, given the condition.
+    def district_probs(self, dem=(), gop=(), national=None):
+        mask = self.condition(dem, gop, national)
+        n = count(mask)
+        both = POPCOUNT[self.winners & mask].sum(axis=1, dtype=np.int64)
+        return dict(zip(self.district_index, both / n)) if n else {}
+
+
+def count(bits):
+    return int(POPCOUNT[bits].sum(dtype=np.int64))
+
+
+def main():
+    args = get_args()
+    scenarios = Scenarios(draws.run_path(args.draws_dir, args.date))
+
+    result = scenarios.query(dem=args.dem, gop=args.gop, national=args.national)
+    print(f"{result['n']:,} of {scenarios.n:,} simulations ({result['share']:.1%}) "
+          "meet the conditions.")
+    if result["n"] > 0:
+        print(f"Democrats have a {result['prob']:.0%} chance of retaking the House.")
+        print(f"They are expected to win {result['seats']} seats "
+              f"(80% interval {result['seats_min']}-{result['seats_max']}).")
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Query stored House simulations.",
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--date", type=lambda s: datetime.strptime(s, "%Y-%m-%d"), required=True,
+            help="Run date whose simulations to use.")
+    parser.add_argument("--dem", type=str, nargs="*", default=[],
+            help="Districts Democrats win, e.g. PA-07.")
+    parser.add_argument("--gop", type=str, nargs="*", default=[],
+            help="Districts Republicans win.")
+    parser.add_argument("--national", type=float, nargs=2, metavar=("LOW", "HIGH"), default=None,
+            help="Range of the national margin, in points (positive for Democrats).")
+    parser.add_argument("--draws_dir", type=str, nargs="?", default="draws",
+            help="Directory in which draws are stored.")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
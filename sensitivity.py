@@ -0,0 +1,231 @@
+# PRIOR SENSITIVITY SWEEPS
+#
+# Runs the forecast under a grid of prior settings without refitting the
+# national model for each one. Changing `mu_prior`, `mu_mse` or the bias
+# prior's `step_var` only changes the prior density of `mu[W]` or `alpha_n`,
+# so the baseline posterior draws are reweighted by the ratio of new to old
+# prior densities, with Pareto-smoothed importance sampling (PSIS; Vehtari et
+# al. 2017). Where the estimated Pareto shape k is above 0.7 the weights are
+# unreliable, and the national model is refit for that setting instead, in
+# parallel. The race prior variances don't enter the national model, so they
+# only change the race simulations.
+#
+# The grid is a JSON file holding either a list of settings or a dict of lists
+# whose product is taken, e.g.
+#   {"mu_mse": [3, 5, 8], "race_dist_var": [20, 30, 40]}
+# Settings are
+#   mu_prior        prior national margin on election day, in points
+#   mu_mse          standard deviation of that prior, in points
+#   step_var        month-to-month covariance of polling bias, in points^2
+#   race_mse_resid  race prior error variance shared by all districts, in points^2
+#   race_dist_var   race prior error variance of each district, in points^2
+# and any that are left out keep their fitted values.
+
+import csv
+import json
+import math
+import argparse
+import itertools
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import approx
+import house
+import simulate
+import timing
+
+SETTINGS = ["mu_prior", "mu_mse", "step_var", "race_mse_resid", "race_dist_var"]
+COLUMNS = SETTINGS + ["method", "k", "ess", "prob", "gain", "seats", "seats_min", "seats_max"]
+
+K_MAX = 0.7
+
+
+def sweep(args, inputs):
+    with open(args.sweep) as f:
+        grid = read_grid(json.load(f))
+
+    max_date = args.date or datetime.now()
+    mcmc_data = house.national_data(max_date, inputs)
+
+    timing.start("fit national model")
+    samples = national_draws(inputs["model"], mcmc_data, args)
+    mu_final = samples["mu"][:, -1]
+    base_log_prior = log_prior(samples, mcmc_data)
+
+    timing.start("reweight")
+    rows = []
+    refits = {}
+    for i, setting in enumerate(grid):
+        data = setting_data(mcmc_data, setting, inputs)
+        row = {k: setting.get(k, "") for k in SETTINGS}
+        if data is mcmc_data:
+            weights, k = np.full(len(mu_final), 1 / len(mu_final)), 0.0
+        else:
+            weights, k = psis(log_prior(samples, data) - base_log_prior)
+        row.update(k=k, ess=1 / np.sum(weights**2))
+        if k <= K_MAX:
+            row["method"] = "psis"
+            row["nat"] = weighted_moments(mu_final, weights)
+        else:
+            row["method"] = "refit"
+            refits[i] = data
+        rows.append(row)
+
+    if refits:
+        timing.start("refit national model")
+        print(f"Refitting the national model for {len(refits)} of {len(grid)} settings.")
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=house.init_worker,
+                                 initargs=(inputs, args)) as pool:
+            futures = {i: pool.submit(refit_worker, data) for i, data in refits.items()}
+            for i, future in futures.items():
+                draws = future.result()
+                rows[i]["nat"] = weighted_moments(draws, np.full(len(draws), 1 / len(draws)))
+                rows[i]["ess"] = len(draws)
+
+    timing.start("simulate races")
+    for setting, row in zip(grid, rows):
+        nat_margin, nat_var = row.pop("nat")
+        races, _, race_predictions = house.race_inputs(100 * nat_margin, inputs)
+        sampler = house.race_sampler(race_predictions, nat_var, races, inputs, args,
+                                     mse_resid=setting.get("race_mse_resid"),
+                                     dist_var=setting.get("race_dist_var"))
+        sim = simulate.simulate_races(sampler, args.race_n, chunk_size=args.chunk_size,
+                                      current_seats=inputs["cycle"]["seats"],
+                                      majority=inputs["cycle"]["majority"],
+                                      target_se=args.target_se, method=args.sim_method,
+                                      control=args.control_variates)
+        row.update({k: sim[k] for k in ["prob", "gain", "seats", "seats_min", "seats_max"]})
+
+    write_table(rows, args.sweep_file)
+    print_table(rows)
+    print(f"Sensitivity table written to {args.sweep_file}.")
+
+# Settings from a list of dicts, or the product of a dict of lists. The first
+# setting is always the fitted priors.
+def read_grid(grid):
+    if isinstance(grid, dict):
+        keys = list(grid)
+        grid = [dict(zip(keys, values)) for values in itertools.product(*grid.values())]
+    for setting in grid:
+        unknown = set(setting) - set(SETTINGS)
+        if unknown:
+            raise ValueError(f"Unknown prior settings: {', '.join(sorted(unknown))}.")
+    return [{}] + [s for s in grid if s]
+
+# Data for the national model under `setting`, or `mcmc_data` itself if the
+# setting leaves the national model unchanged.
+def setting_data(mcmc_data, setting, inputs):
+    changes = {}
+    if "mu_prior" in setting:
+        changes["mu_prior"] = setting["mu_prior"] / 100
+    if "mu_mse" in setting:
+        changes["mu_mse"] = setting["mu_mse"] / 100
+    if "step_var" in setting:
+        changes["sigma_n_prior"] = house.bias_covariance(
+                mcmc_data["M"], inputs["bias_prior"].mse_resid / 100**2,
+                setting["step_var"] / 100**2)
+    return {**mcmc_data, **changes} if changes else mcmc_data
+
+# Log prior density of each draw, up to a constant shared by all settings.
+# `mu[W]` is normal around `mu_prior` and `alpha_n` is multivariate normal
+# around `alpha_n_prior`; nothing else depends on the swept settings.
+def log_prior(samples, mcmc_data):
+    z = (samples["mu"][:, -1] - mcmc_data["mu_prior"]) / mcmc_data["mu_mse"]
+    lp = -0.5 * z**2 - math.log(mcmc_data["mu_mse"])
+
+    chol = np.linalg.cholesky(mcmc_data["sigma_n_prior"])
+    resid = np.linalg.solve(chol, (samples["alpha_n"] - mcmc_data["alpha_n_prior"]).T)
+    lp += -0.5 * np.sum(resid**2, axis=0) - np.sum(np.log(np.diag(chol)))
+    return lp
+
+def weighted_moments(x, weights):
+    mean = np.sum(weights * x)
+    return mean, np.sum(weights * (x - mean)**2)
+
+
+def national_draws(model, mcmc_data, args):
+    if args.approx:
+        return approx.draw(model, mcmc_data, args.approx, args.approx_n)
+    return house.run_nuts(model, mcmc_data, args)[1]
+
+def refit_worker(mcmc_data):
+    args = argparse.Namespace(**{**vars(house._worker_state["args"]), "warm_start": False})
+    return national_draws(house._worker_state["inputs"]["model"], mcmc_data, args)["mu"][:, -1]
+
+
+#################################
+# Pareto-smoothed importance    #
+# sampling                      #
+#################################
+
+# Normalized PSIS weights from log importance ratios, and the estimated shape
+# of the Pareto tail of the ratios.
+def psis(log_ratios):
+    lw = np.asarray(log_ratios, dtype=float) - np.max(log_ratios)
+    n = len(lw)
+    m = int(min(0.2 * n, 3 * math.sqrt(n)))
+
+    order = np.argsort(lw)
+    cutoff = lw[order[-m - 1]]
+    tail = order[-m:]
+    exceed = np.exp(lw[tail]) - math.exp(cutoff)
+
+    if m < 5:
+        k = np.inf
+    elif exceed[int(m / 4 + 0.5) - 1] <= 0:
+        k = 0.0 # flat tail, e.g. an unchanged prior; nothing to smooth
+    else:
+        k, sigma = gpdfit(exceed)
+        if np.isfinite(k):
+            # replace the tail by expected order statistics, capped at the
+            # largest raw ratio
+            p = (np.arange(1, m + 1) - 0.5) / m
+            lw[tail] = np.log(np.minimum(math.exp(cutoff) + gpinv(p, k, sigma), 1.0))
+
+    w = np.exp(lw)
+    return w / w.sum(), float(k)
+
+# Generalized Pareto fit to sorted exceedances, as in Zhang and Stephens (2009)
+# with a weakly informative prior on the shape.
+def gpdfit(x):
+    n = len(x)
+    m = 30 + int(math.sqrt(n))
+    b = 1 - np.sqrt(m / (np.arange(1, m + 1) - 0.5))
+    b /= 3 * x[int(n / 4 + 0.5) - 1]
+    b += 1 / x[-1]
+
+    k = np.log1p(-b[:, None] * x).mean(axis=1)
+    profile = n * (np.log(-b / k) - k - 1)
+    w = 1 / np.exp(profile - profile[:, None]).sum(axis=1)
+    keep = w >= 10 * np.finfo(float).eps
+    b, w = b[keep], w[keep] / w[keep].sum()
+
+    b_post = np.sum(b * w)
+    k_post = np.log1p(-b_post * x).mean()
+    sigma = -k_post / b_post
+    k_post = (n * k_post + 10 * 0.5) / (n + 10)
+    return k_post, sigma
+
+def gpinv(p, k, sigma):
+    if abs(k) < 1e-12:
+        return -sigma * np.log1p(-p)
+    return sigma * np.expm1(-k * np.log1p(-p)) / k
+
+
+def write_table(rows, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: round(v, 4) if isinstance(v, float) else v
+                             for k, v in row.items()})
+
+def print_table(rows):
+    print(" ".join(f"{c:>14}" for c in SETTINGS) + "  method      k    ess   prob  gain  seats")
+    for row in rows:
+        settings = " ".join(f"{row[c]:>14}" for c in SETTINGS)
+        print(f"{settings}  {row['method']:<6} {row['k']:6.2f} {row['ess']:6.0f} "
+              f"{row['prob']:6.1%} {row['gain']:5.0f}  {row['seats']} "
+              f"({row['seats_min']}-{row['seats_max']})")
@@ -0,0 +1,139 @@
+# FORECAST SERVER
+#
+# Keeps the priors, compiled model and downloaded data loaded, and runs
+# forecasts on request in a pool of worker processes. Started with
+# `./house.py --serve`; listens on localhost:PORT, or on a Unix socket if
+# --socket is given.
+#
+#   GET  /health    server status
+#   POST /forecast  run a forecast; the JSON body may set "date" (YYYY-MM-DD),
+#                   any of OPTIONS, and "save" to also write the output file
+#                   and log the run. Responds with the output file's contents.
+#   POST /reload    reload data (e.g. to pick up new polls)
+
+import os
+import json
+import argparse
+import threading
+import socketserver
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import house
+import output
+
+# options a request may override
+OPTIONS = {"nat_n": int, "race_n": int, "chains": int, "chunk_size": int,
+           "target_se": float, "state_sd": float, "output_format": str, "precision": int,
+           "approx": str, "approx_n": int, "converge": bool, "batch_n": int,
+           "sim_method": str, "control_variates": bool}
+
+
+# `value` of option `key` as its type. Flags must be JSON booleans, since
+# bool("false") is True.
+def option(key, value):
+    if OPTIONS[key] is bool and not isinstance(value, bool):
+        raise ValueError(f"Option {key} must be true or false.")
+    return OPTIONS[key](value)
+
+
+class ForecastService:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.pool = None
+        self.reload()
+
+    def reload(self):
+        inputs = house.load_inputs(self.args)
+        pool = ProcessPoolExecutor(max_workers=self.args.jobs, initializer=house.init_worker,
+                                   initargs=(inputs, self.args))
+        with self.lock:
+            old, self.pool = self.pool, pool
+            self.loaded = datetime.now()
+        if old is not None:
+            old.shutdown(wait=True)
+
+    def forecast(self, request):
+        max_date = house.date_type(request["date"]) if "date" in request else datetime.now()
+        overrides = {k: option(k, v) for k, v in request.items() if k in OPTIONS}
+        args = argparse.Namespace(**{**vars(self.args), **overrides})
+
+        with self.lock:
+            future = self.pool.submit(house.forecast_worker, max_date, overrides)
+        output_data = future.result()
+
+        if request.get("save"):
+            with self.lock:
+                house.write_output(output_data, args)
+                house.log_history([output_data], args)
+                house.save_results([output_data], args)
+
+        return output.format_output(output_data, args.output_format, args.precision)
+
+    def status(self):
+        return {"status": "ok", "loaded": self.loaded.isoformat(timespec="seconds"),
+                "workers": self.args.jobs}
+
+
+class Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.respond(200, self.service.status())
+        else:
+            self.respond(404, {"error": f"Unknown path {self.path}."})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if self.path == "/forecast":
+                self.respond(200, self.service.forecast(request))
+            elif self.path == "/reload":
+                self.service.reload()
+                self.respond(200, self.service.status())
+            else:
+                self.respond(404, {"error": f"Unknown path {self.path}."})
+        except (ValueError, argparse.ArgumentTypeError) as e:
+            self.respond(400, {"error": str(e)})
+        except Exception as e:
+            self.respond(500, {"error": repr(e)})
+
+    def respond(self, code, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Unix socket clients have no address
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve(args):
+    Handler.service = ForecastService(args)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        httpd = UnixHTTPServer(args.socket, Handler)
+        print(f"Serving forecasts on {args.socket}.")
+    else:
+        httpd = ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+        print(f"Serving forecasts on http://127.0.0.1:{args.port}.")
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        Handler.service.pool.shutdown()
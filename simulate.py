@@ -0,0 +1,274 @@
+# MONTE CARLO SIMULATION OF INDIVIDUAL RACES
+
+import math
+
+import numpy as np
+import pandas as pd
+
+
+# Sampler drawing from a dense multivariate normal. The factorization is done
+# once, so each chunk only costs a matrix multiply.
+def dense_sampler(means, cov_matrix):
+    means = np.asarray(means, dtype=float)
+    u, s, _ = np.linalg.svd(cov_matrix, hermitian=True)
+    factor = u * np.sqrt(np.maximum(s, 0))
+
+    def draw(n, normals=None):
+        if normals is None:
+            normals = np.random.standard_normal((n, len(means)))
+        return means + normals @ factor.T
+
+    draw.means = means
+    draw.dim = len(means)
+    return draw
+
+
+# Sampler for the covariance structure of the race model: a shared national
+# shock with variance `common_var` plus independent district errors with
+# variance `dist_var`, i.e. the same distribution as `dense_sampler` with a
+# constant off-diagonal, at O(n * districts) cost per draw. If `groups` (e.g.
+# each district's state) is given, `group_var` of the district variance is
+# moved into a shock shared within each group, leaving marginal variances
+# unchanged.
+#
+# Samplers take an optional (n, dim) array of standard normals to transform;
+# here the national shock is the first column and the group shocks follow, so
+# the most important dimensions come first for quasi-random points.
+def factor_sampler(means, common_var, dist_var, groups=None, group_var=0.0):
+    means = np.asarray(means, dtype=float)
+    indep_var = dist_var - common_var - (group_var if groups is not None else 0)
+    if indep_var < 0:
+        raise ValueError("District variance must be at least the shared variance.")
+
+    n_groups = 0
+    if groups is not None:
+        codes, uniques = pd.factorize(np.asarray(groups))
+        n_groups = len(uniques)
+    nat_sd = math.sqrt(common_var)
+    indep_sd = math.sqrt(indep_var)
+
+    def draw(n, normals=None):
+        if normals is None:
+            normals = np.random.standard_normal((n, 1 + n_groups + len(means)))
+        results = normals[:, 1 + n_groups:] * indep_sd
+        results += means
+        results += nat_sd * normals[:, :1]
+        if groups is not None:
+            results += math.sqrt(group_var) * normals[:, 1:1 + n_groups][:, codes]
+        return results
+
+    draw.means = means
+    draw.dim = 1 + n_groups + len(means)
+    return draw
+
+
+METHODS = ["mc", "antithetic", "sobol"]
+
+# Function returning `n` rows of `dim` standard normals, and the number of
+# consecutive rows that form one independent unit for standard errors:
+#   mc          independent pseudo-random draws
+#   antithetic  pairs of draws z and -z
+#   sobol       blocks of `block` Sobol points, each randomized independently,
+#               mapped through the normal inverse CDF
+# `n` must be a multiple of the unit size.
+def normal_source(method, dim, block=1024):
+    if method == "mc":
+        return (lambda n: np.random.standard_normal((n, dim))), 1
+
+    if method == "antithetic":
+        def antithetic(n):
+            z = np.random.standard_normal((n // 2, 1, dim))
+            return np.concatenate([z, -z], axis=1).reshape(n, dim)
+        return antithetic, 2
+
+    if method == "sobol":
+        from scipy.special import ndtri
+        from scipy.stats import qmc
+
+        if block & (block - 1):
+            raise ValueError("Sobol blocks must be a power of two.")
+        # each block is the first `block` Sobol points with a random digital
+        # shift (XOR), which keeps their spread and makes each point uniform,
+        # and is much cheaper than scrambling anew
+        base = qmc.Sobol(dim, scramble=False).random_base2(int(math.log2(block)))
+        base = (base * 2**32).astype(np.uint64)
+
+        # some pairs of Sobol dimensions are poorly spread at these sample
+        # sizes, so every dimension after the first is also shuffled in each
+        # block, spreading that error over all districts
+        def sobol(n):
+            points = []
+            for _ in range(n // block):
+                shift = np.random.randint(0, 2**32, dim, dtype=np.uint64)
+                order = np.concatenate([[0], 1 + np.random.permutation(dim - 1)])
+                points.append((((base ^ shift) + 0.5) / 2**32)[:, order])
+            return ndtri(np.concatenate(points))
+        return sobol, block
+
+    raise ValueError(f"Unknown simulation method {method}.")
+
+
+# Simulate races `chunk_size` draws at a time, folding each chunk into running
+# totals so that memory does not grow with `n` (beyond the seat count and
+# national environment of each draw). If `target_se` is given, stop as soon as
+# the standard error of the majority probability is below it and the standard
+# error of the median seat count is below `target_seats_se`. Each chunk of
+# draws is passed to `sink`, if given, before it is discarded.
+#
+# `method` is one of METHODS (see `normal_source`); `n` and `chunk_size` are
+# rounded to whole units, and `n` to at least two units. With `control`,
+# estimates are adjusted with control variates: each district's deviation from
+# its mean margin for its win probability, and the average deviation (the
+# national environment) for the seat distribution, both of which have known
+# mean zero.
+def simulate_races(sampler, n, chunk_size=5000, current_seats=194, majority=218,
+                   target_se=None, target_seats_se=0.5, sink=None, method="mc",
+                   control=False, block=1024):
+    normals, unit = normal_source(method, sampler.dim, block)
+    # standard errors need at least two units
+    n = max(math.ceil(n / unit), 2) * unit
+    chunk_size = max(chunk_size // unit, 1) * unit
+
+    n_races = len(sampler.means)
+    mean = np.zeros(n_races)
+    m2 = np.zeros(n_races)
+    # sums of district wins and deviations from the mean margin over draws and,
+    # for standard errors, over units (the same thing for independent draws)
+    draw_sums = {k: np.zeros(n_races) for k in ["w", "ww", "x", "xx", "wx"]}
+    unit_sums = draw_sums if unit == 1 else {k: np.zeros(n_races) for k in draw_sums}
+    seats = []
+    environment = []
+    done = 0
+
+    while done < n:
+        k = min(chunk_size, n - done)
+        results = sampler(k, normals(k))
+        if sink is not None:
+            sink(results)
+
+        # merge chunk mean and sum of squares (Chan et al.)
+        chunk_mean = results.mean(axis=0)
+        chunk_m2 = ((results - chunk_mean)**2).sum(axis=0)
+
+        delta = chunk_mean - mean
+        total = done + k
+        mean += delta * k / total
+        m2 += chunk_m2 + delta**2 * done * k / total
+
+        won = results > 0
+        dev = results - sampler.means if control else None
+        add_moments(draw_sums, won, dev)
+        if unit > 1:
+            add_moments(unit_sums, unit_means(won, unit),
+                        unit_means(dev, unit) if control else None)
+        seats.append(won.sum(axis=1))
+        if control:
+            environment.append(dev.mean(axis=1))
+        done = total
+
+        if target_se is not None:
+            est = seat_estimates(np.concatenate(seats), environment, unit, n_races,
+                                 majority, control)
+            if est["se"]["prob"] <= target_se and est["se"]["seats"] <= target_seats_se:
+                break
+
+    est = seat_estimates(np.concatenate(seats), environment, unit, n_races, majority, control)
+    prob_district, district_se = district_estimates(draw_sums, unit_sums, done, unit, control)
+    seats_hist = est["hist"]
+    median = seat_quantile(seats_hist, 0.5)
+
+    return {
+        "n": done,
+        "margin": mean,
+        "std": np.sqrt(m2 / done),
+        "prob_district": prob_district,
+        "seats_hist": seats_hist,
+        "prob": seats_hist[majority:].sum(),
+        "seats": median,
+        "seats_min": seat_quantile(seats_hist, 0.1),
+        "seats_max": seat_quantile(seats_hist, 0.9),
+        "gain": median - current_seats,
+        "dem_gain": seats_hist[current_seats + 1:].sum(),
+        "gop_gain": seats_hist[:current_seats].sum(),
+        "se": {**est["se"], "district": float(np.max(district_se))},
+    }
+
+def add_moments(sums, w, x=None):
+    sums["w"] += w.sum(axis=0)
+    if w.dtype != bool:
+        sums["ww"] += (w**2).sum(axis=0)
+    if x is not None:
+        sums["x"] += x.sum(axis=0)
+        sums["xx"] += (x**2).sum(axis=0)
+        sums["wx"] += (w * x).sum(axis=0)
+
+def unit_means(values, unit):
+    return values.reshape(-1, unit, values.shape[1]).mean(axis=1)
+
+# Seat distribution from the seat count and national environment of each draw,
+# and the standard errors of the majority probability and median seat count,
+# from the variation between units.
+def seat_estimates(seats, environment, unit, n_races, majority, control):
+    n = len(seats)
+    hist = np.bincount(seats, minlength=n_races + 1) / n
+    beta = np.zeros(n_races + 1)
+    environment = np.concatenate(environment) if control else np.zeros(n)
+    if control:
+        env_mean = environment.mean()
+        env_var = environment.var()
+        if env_var > 0:
+            cov = np.bincount(seats, weights=environment, minlength=n_races + 1) / n \
+                  - hist * env_mean
+            beta = cov / env_var
+            hist = hist - beta * env_mean
+
+    median = seat_quantile(hist, 0.5)
+    majority_se = unit_se((seats >= majority) - beta[majority:].sum() * environment, unit)
+    below_se = unit_se((seats <= median) - beta[:median + 1].sum() * environment, unit)
+
+    return {"hist": hist, "se": standard_errors(hist, majority_se, below_se)}
+
+# Win probability of each district and its standard error.
+def district_estimates(draw_sums, unit_sums, n, unit, control):
+    prob = draw_sums["w"] / n
+    beta = np.zeros_like(prob)
+    if control:
+        x_mean = draw_sums["x"] / n
+        x_var = draw_sums["xx"] / n - x_mean**2
+        cov = draw_sums["wx"] / n - prob * x_mean
+        beta = np.divide(cov, x_var, out=np.zeros_like(cov), where=x_var > 1e-15)
+        prob = np.clip(prob - beta * x_mean, 0, 1)
+
+    units = n // unit
+    moments = {k: v / units for k, v in unit_sums.items()}
+    if unit == 1: # wins are 0 or 1
+        moments["ww"] = moments["w"]
+    var = (moments["ww"] - moments["w"]**2
+           - 2 * beta * (moments["wx"] - moments["w"] * moments["x"])
+           + beta**2 * (moments["xx"] - moments["x"]**2))
+    return prob, np.sqrt(np.maximum(var, 0) / max(units - 1, 1))
+
+def unit_se(values, unit):
+    means = values.reshape(-1, unit).mean(axis=1)
+    if len(means) < 2:
+        return math.inf
+    return float(np.std(means, ddof=1) / math.sqrt(len(means)))
+
+
+# Monte Carlo standard errors of the majority probability and the median seat
+# count, given those of the majority probability and of the seat
+# distribution's CDF at the median. The latter is divided by the density at the
+# median, smoothed over nearby seat counts, as in the asymptotic variance of a
+# sample median, 1 / (4 n f(median)^2).
+def standard_errors(seats_hist, prob_se, cdf_se, window=2):
+    median = seat_quantile(seats_hist, 0.5)
+    lo = max(median - window, 0)
+    density = seats_hist[lo:median + window + 1].mean()
+
+    return {
+        "prob": prob_se,
+        "seats": float(cdf_se / density) if density > 0 else math.inf,
+    }
+
+def seat_quantile(seats_hist, q):
+    return int(np.searchsorted(np.cumsum(seats_hist), q - 1e-12))
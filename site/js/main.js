@@ -2,7 +2,7 @@ import graphics from "./graphics";
 
 async function main() {
     let resp = await fetch("data/output.json");
-    let data = await resp.json();
+    let data = fromColumnar(await resp.json());
     window.data = data;
 
     fill_summary(data);
@@ -20,6 +20,24 @@ async function main() {
     graphics.races(data, states, $(".tables"));
 }
 
+// Output may store tables as one array per field; expand them into rows.
+function fromColumnar(data) {
+    if (data.format != "columnar") return data;
+
+    let toRecords = table => {
+        let fields = Object.keys(table);
+        return table[fields[0]].map((_, i) => {
+            let row = {};
+            fields.forEach(f => row[f] = table[f][i]);
+            return row;
+        });
+    };
+    data.districts = toRecords(data.districts);
+    data.generic = toRecords(data.generic);
+
+    return data;
+}
+
 function fill_summary(data) {
     let odds = data.prob / (1 - data.prob);
     let direction = odds > 1 ? "for" : "against";
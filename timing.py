@@ -0,0 +1,72 @@
+# PER-STAGE TIMING AND RESOURCE USE
+#
+# Stages are recorded in the order they run, with wall time, CPU time (of this
+# process and any finished child processes, e.g. Stan chains), the peak
+# resident memory of this process so far, in MB, and how much the stage raised
+# that peak. The peak only ever rises, so the increase is what a stage itself
+# needed beyond earlier stages.
+
+import sys
+import time
+import resource
+
+stages = []
+notes = {}
+current = {}
+
+
+def reset():
+    stages.clear()
+    notes.clear()
+    current.clear()
+
+# Begin a stage, ending the one in progress.
+def start(name):
+    stop()
+    current.update(stage=name, wall=time.perf_counter(), cpu=cpu_time(), peak_rss=peak_rss())
+
+def stop():
+    if not current:
+        return
+    stages.append({
+        "stage": current["stage"],
+        "wall": time.perf_counter() - current["wall"],
+        "cpu": cpu_time() - current["cpu"],
+        "peak_rss": peak_rss(),
+        "peak_rss_increase": peak_rss() - current["peak_rss"],
+    })
+    current.clear()
+
+# Attach other statistics (e.g. from the sampler) to the report.
+def note(name, value):
+    notes[name] = value
+
+def report():
+    stop()
+    return {
+        "stages": list(stages),
+        "total": {
+            "wall": sum(s["wall"] for s in stages),
+            "cpu": sum(s["cpu"] for s in stages),
+            "peak_rss": max([s["peak_rss"] for s in stages], default=peak_rss()),
+        },
+        **notes,
+    }
+
+def print_report():
+    print(f"{'Stage':<20} {'Wall (s)':>10} {'CPU (s)':>10} {'Peak RSS so far (MB)':>21} "
+          f"{'Increase (MB)':>14}")
+    for s in stages:
+        print(f"{s['stage']:<20} {s['wall']:>10.2f} {s['cpu']:>10.2f} {s['peak_rss']:>21.0f} "
+              f"{s['peak_rss_increase']:>14.0f}")
+
+
+def cpu_time():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 1024**2 if sys.platform == "darwin" else rss / 1024
@@ -0,0 +1,115 @@
+# WARM STARTS FOR THE NATIONAL MODEL
+#
+# After each run we keep the posterior means of the parameters, the adapted
+# step sizes, and the (diagonal) inverse mass matrices. If the next run's polls
+# are the old polls with new ones added at one end, sampling can start from
+# there with a much shorter warmup, which only adapts the step size: the
+# saved mass matrices are kept fixed (a short warmup would otherwise fall back
+# to Stan's default windows and re-estimate them from a few dozen draws).
+
+import os
+import pickle
+
+import numpy as np
+
+import cache
+import posterior
+
+POLL_FIELDS = ["w", "m", "n_resp", "n_dem", "p"]
+PARAMS = ["alpha_n_r", "alpha_p_r", "delta_mu", "u", "sigma_p", "sigma_e", "sigma_walk"]
+
+
+def save_state(path, fit, mcmc_data):
+    means = posterior.summarize([fit], PARAMS)
+    state = {
+        "data": {k: np.asarray(mcmc_data[k]) for k in POLL_FIELDS + ["W", "M", "N", "P"]},
+        "init": {k: means[k]["mean"] for k in PARAMS},
+        "stepsize": list(fit.get_stepsize()),
+        "inv_metric": [np.asarray(x) for x in fit.get_inv_metric(as_dict=False)],
+    }
+    cache.write(path, pickle.dumps(state))
+
+# Keyword arguments for `StanModel.sampling` that resume from the saved state,
+# or None if there is no state or it does not match `mcmc_data`.
+def resume_args(path, mcmc_data, chains, warmup):
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        state = pickle.load(f)
+
+    new_polls = poll_offset(state["data"], mcmc_data)
+    if new_polls is None:
+        return None
+
+    old = state["data"]
+    init = dict(state["init"])
+    init["u"] = insert_zeros(init["u"], new_polls, mcmc_data["N"] - old["N"])
+    init["alpha_p_r"] = insert_zeros(init["alpha_p_r"], old["P"], mcmc_data["P"] - old["P"])
+
+    # unconstrained parameters are laid out in declaration order
+    offsets = np.cumsum([0, old["M"], old["P"], old["W"]])
+    inv_metric = {}
+    for chain in range(chains):
+        metric = state["inv_metric"][chain % len(state["inv_metric"])]
+        metric = np.insert(metric, offsets[3] + new_polls,
+                           np.ones(mcmc_data["N"] - old["N"]))
+        metric = np.insert(metric, offsets[2], np.ones(mcmc_data["P"] - old["P"]))
+        inv_metric[chain] = metric
+
+    return {
+        "init": [init] * chains,
+        "warmup": warmup,
+        "control": {
+            "stepsize": float(np.mean(state["stepsize"])),
+            "metric": "diag_e",
+            "inv_metric": inv_metric,
+            # the whole warmup is the initial fast-adaptation buffer (step
+            # size only); there are no metric windows
+            "adapt_init_buffer": warmup,
+            "adapt_term_buffer": 0,
+            "adapt_window": 0,
+        },
+    }
+
+# Keyword arguments for `StanModel.sampling` that continue each chain of `fit`
+# from its last draw, keeping its adaptation.
+def continue_args(fit, chains):
+    init = [{} for chain in range(chains)]
+    for par in PARAMS:
+        names, dims = posterior.element_names(fit, par)
+        last = np.array([[view[-1] for view in posterior.chain_views(fit, name)]
+                         for name in names])
+        for chain in range(chains):
+            init[chain][par] = posterior.shape(last[:, chain], dims)
+    inv_metric = fit.get_inv_metric(as_dict=False)
+
+    return {
+        "init": init,
+        "warmup": 0,
+        "control": {
+            "stepsize": float(np.mean(fit.get_stepsize())),
+            "metric": "diag_e",
+            "inv_metric": {chain: np.asarray(inv_metric[chain]) for chain in range(chains)},
+            "adapt_engaged": False,
+        },
+    }
+
+# Where the new polls go in the poll arrays (0 if they precede the old polls,
+# N if they follow them), or None if the old polls are not a contiguous block
+# of the new ones with the same weeks, months and pollsters.
+def poll_offset(old, mcmc_data):
+    if old["W"] != mcmc_data["W"] or old["M"] != mcmc_data["M"]:
+        return None
+    n_old, n_new = old["N"], mcmc_data["N"]
+    if n_new < n_old or mcmc_data["P"] < old["P"]:
+        return None
+
+    for start, offset in [(0, n_old), (n_new - n_old, 0)]:
+        if all(np.array_equal(old[k], np.asarray(mcmc_data[k])[start:start + n_old])
+               for k in POLL_FIELDS):
+            return offset
+
+    return None
+
+def insert_zeros(values, at, n):
+    return np.insert(np.asarray(values, dtype=float), at, np.zeros(n))